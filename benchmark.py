@@ -0,0 +1,394 @@
+import argparse, coloredlogs, io, json, logging, os, platform, subprocess, sys, tempfile, threading, time, typing, zipfile
+import numpy as np
+from datetime import datetime, UTC, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from lib import HttpClient
+from lib.DataStructures import OHLCV, OHLCVBatch, InsertReport, KLINE_DTYPE, get_fields_dtype
+from lib.KlineWriter import KlineWriter
+from lib.ParquetStorage import ParquetStorage
+from lib.SpotKlines import build_url, fetch_and_store_klines
+from lib.Storage import KlineStorage
+from lib.utility import *
+from lib.Types import *
+
+
+# offline benchmark of the ingest path. a local http server stands in for data.binance.vision (daily / monthly zips, .CHECKSUM)
+# and the rest klines endpoint, the synthetic klines are deterministic. results are written as json and can be compared
+# with the results of another commit:
+#   python benchmark.py --output before.json
+#   python benchmark.py --compare before.json
+
+
+BENCHMARK_INTERVALS = ["1s", "1m", "1h"]
+STAGES = ["download", "unzip", "csv_parse", "ohlcv_batch", "ohlcv_models", "insert", "reinsert", "end_to_end"]
+STAND_IN_HOSTS = ["https://data.binance.vision", "https://data-api.binance.vision", "https://api.binance.com"]
+
+
+
+class SyntheticKlines:
+    # deterministic klines of every symbol and interval from `start` (inclusive) to `end` (exclusive), both ms
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+
+
+    def get_rows(self, symbol: str, interval: t_interval, start: int, end: int) -> np.ndarray:
+        step = interval_to_milliseconds(interval)
+        start, end = max(start, self.start), min(end, self.end)
+        open_times = np.arange(-(-start // step) * step, end, step, dtype=np.int64)
+
+        columns = np.zeros(len(open_times), dtype=KLINE_DTYPE)
+        if not len(open_times):
+            return columns
+
+        # the price only depends on the open_time. every archive can be generated independently
+        price = 100 + 10 * np.sin(open_times / 3.6e6) + (open_times % 7919) / 7919
+        columns["open_time"] = open_times
+        columns["open"] = np.round(price, 2)
+        columns["high"] = np.round(price + 0.5, 2)
+        columns["low"] = np.round(price - 0.5, 2)
+        columns["close"] = np.round(price + 0.1, 2)
+        columns["volume"] = np.round((open_times % 1000) / 7 + 1, 8)
+        columns["close_time"] = open_times + step - 1
+        columns["quote_asset_volume"] = np.round(columns["volume"] * price, 8)
+        columns["number_of_trades"] = open_times % 97 + 1
+        columns["taker_buy_base_asset_volume"] = np.round(columns["volume"] / 2, 8)
+        columns["taker_buy_quote_asset_volume"] = np.round(columns["quote_asset_volume"] / 2, 8)
+        return columns
+
+
+    def get_csv(self, symbol: str, interval: t_interval, start: int, end: int) -> bytes:
+        columns = self.get_rows(symbol=symbol, interval=interval, start=start, end=end)
+        buffer = io.StringIO()
+        buffer.write(",".join(KLINE_DTYPE.names) + "\n")  # header row of the newer archives
+        np.savetxt(buffer, np.column_stack([columns[name].astype(str) for name in KLINE_DTYPE.names]), fmt="%s", delimiter=",")
+        return buffer.getvalue().encode()
+
+
+    def get_zip(self, name: str, symbol: str, interval: t_interval, start: int, end: int) -> bytes:
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as zip:
+            zip.writestr(f"{name}.csv", self.get_csv(symbol=symbol, interval=interval, start=start, end=end))
+        return buffer.getvalue()
+
+
+
+class StandInServer:
+    # local stand-in for data.binance.vision and the klines endpoint. generated zips are kept in memory
+    def __init__(self, klines: SyntheticKlines):
+        self.klines = klines
+        self._zips: typing.Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+        stand_in = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True  # headers and body are written separately
+
+            def do_GET(self):
+                status, body = stand_in.handle(self.path)
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, name="stand-in-server", daemon=True).start()
+
+
+    def get_archive(self, path: str) -> bytes | None:
+        # /data/spot/{daily|monthly}/klines/{symbol}/{interval}/{symbol}-{interval}-{date}.zip
+        with self._lock:
+            if path in self._zips:
+                return self._zips[path]
+
+        parts = path.split("/")
+        name = parts[-1][:-len(".zip")]
+        period, symbol, interval = parts[-5], parts[-3], parts[-2]
+        date = name[len(f"{symbol}-{interval}-"):]
+
+        if period == "monthly":
+            start = datetime.strptime(date, "%Y-%m").replace(tzinfo=UTC)
+            end = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+        else:
+            start = datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=UTC)
+            end = start + timedelta(days=1)
+        start, end = int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+        if start < self.klines.start or end > self.klines.end:
+            return None
+
+        archive = self.klines.get_zip(name=name, symbol=symbol, interval=interval, start=start, end=end)
+        with self._lock:
+            self._zips[path] = archive
+        return archive
+
+
+    def handle(self, path: str) -> typing.Tuple[int, bytes]:
+        url = urlsplit(path)
+        if url.path.endswith("/klines"):
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            step = interval_to_milliseconds(query["interval"])
+            start = max(int(query.get("startTime", 0)), self.klines.start)
+            end = min(int(query.get("endTime", self.klines.end)) + 1, start + int(query.get("limit", 500)) * step)
+            rows = self.klines.get_rows(symbol=query["symbol"], interval=query["interval"], start=start, end=end)
+            return 200, json.dumps([[str(value) if name not in ("open_time", "close_time", "number_of_trades") else value for name, value in zip(KLINE_DTYPE.names, row)] for row in rows.tolist()]).encode()
+
+        if url.path.endswith(".zip.CHECKSUM"):
+            archive = self.get_archive(url.path[:-len(".CHECKSUM")])
+            return (404, b"") if archive is None else (200, f"{hashlib.sha256(archive).hexdigest()}  {url.path.split('/')[-1][:-len('.CHECKSUM')]}".encode())
+
+        if url.path.endswith(".zip"):
+            archive = self.get_archive(url.path)
+            return (404, b"") if archive is None else (200, archive)
+        return 404, b""
+
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+
+class MemoryStorage(KlineStorage):
+    # in-process stand-in for the storage backends. one sorted structured array per collection
+    def __init__(self):
+        self._klines: typing.Dict[typing.Tuple[str, str, str], np.ndarray] = {}
+        self._lock = threading.Lock()
+
+
+    def _get(self, market: t_market, symbol: str, interval: t_interval) -> np.ndarray:
+        return self._klines.get((market, symbol, interval), np.empty(0, dtype=KLINE_DTYPE))
+
+
+    def _get_last_close_time(self, market: t_market, symbol: str, interval: t_interval) -> int | None:
+        klines = self._get(market=market, symbol=symbol, interval=interval)
+        return int(klines["close_time"][-1]) if len(klines) else None
+
+
+    def _get_first_open_time(self, market: t_market, symbol: str, interval: t_interval) -> int | None:
+        klines = self._get(market=market, symbol=symbol, interval=interval)
+        return int(klines["open_time"][0]) if len(klines) else None
+
+
+    def _write_klines(self, market: t_market, symbol: str, interval: t_interval, klines: OHLCVBatch) -> InsertReport:
+        with self._lock:
+            merged = np.concatenate([self._get(market=market, symbol=symbol, interval=interval), klines.columns])
+            self._klines[(market, symbol, interval)] = merged[np.argsort(merged["open_time"], kind="stable")]
+        return InsertReport(inserted=len(klines))
+
+
+    def read_klines(self, market: t_market, symbol: str, interval: t_interval, start: int | None = None, end: int | None = None, fields: typing.List[str] | None = None) -> OHLCVBatch | np.ndarray:
+        klines = self._get(market=market, symbol=symbol, interval=interval)
+        first = np.searchsorted(klines["open_time"], start, side="left") if start is not None else 0
+        last = np.searchsorted(klines["open_time"], end, side="right") if end is not None else len(klines)
+        if fields is None:
+            return OHLCVBatch(klines[first:last].copy())
+
+        selected = np.empty(last - first, dtype=get_fields_dtype(fields))
+        for name in fields:
+            selected[name] = klines[name][first:last]
+        return selected
+
+
+    def read_open_times(self, market: t_market, symbol: str, interval: t_interval) -> np.ndarray:
+        return self._get(market=market, symbol=symbol, interval=interval)["open_time"].copy()
+
+
+    def normalize_timestamps(self, market: t_market, symbol: str, interval: t_interval) -> int:
+        # the benchmark only writes klines parsed into milliseconds
+        return 0
+
+
+    def _get_last_trade(self, market: t_market, symbol: str, trade_type: t_trade_type) -> typing.Tuple[int, int] | None:
+        # the benchmark covers klines only
+        return None
+
+
+    def _write_trades(self, market: t_market, symbol: str, trade_type: t_trade_type, trades: np.ndarray) -> InsertReport:
+        return InsertReport(inserted=len(trades))
+
+
+
+class StageTimer:
+    # rows and latencies (seconds) of one stage. one latency per archive or batch
+    def __init__(self):
+        self.rows = 0
+        self.latencies: typing.List[float] = []
+
+
+    def measure(self, func: typing.Callable, rows: typing.Callable[[typing.Any], int] | int = 0):
+        start = time.perf_counter()
+        result = func()
+        self.latencies.append(time.perf_counter() - start)
+        self.rows += rows(result) if callable(rows) else rows
+        return result
+
+
+    def summary(self) -> typing.Dict[str, float]:
+        seconds = float(sum(self.latencies))
+        latencies = np.array(self.latencies or [0.0]) * 1000
+        return {
+            "rows": self.rows,
+            "seconds": round(seconds, 6),
+            "rows_per_second": round(self.rows / seconds, 1) if seconds else 0.0,
+            "latency_ms_mean": round(float(latencies.mean()), 3),
+            "latency_ms_p50": round(float(np.percentile(latencies, 50)), 3),
+            "latency_ms_p95": round(float(np.percentile(latencies, 95)), 3),
+            "latency_ms_max": round(float(latencies.max()), 3),
+        }
+
+
+
+def create_benchmark_storage(storage: str, mongo_uri: str | None, base_dir: str) -> KlineStorage:
+    if storage == "memory":
+        return MemoryStorage()
+    elif storage == "parquet":
+        return ParquetStorage(root_dir=os.path.join(base_dir, "parquet"))
+    elif storage == "mongo":
+        from lib.DAO import DAO
+        import pymongo
+        databases = {market: f"benchmark_{market}_klines" for market in typing.get_args(t_market)}
+        client = pymongo.MongoClient(mongo_uri)
+        for database in databases.values():
+            client.drop_database(database)
+        return DAO(uri=mongo_uri, SPOT_KLINE_DB=databases["spot"], UM_KLINE_DB=databases["um"], CM_KLINE_DB=databases["cm"])
+    else: raise generate_invalid_arg_exception("storage", storage)
+
+
+def read_zip(source: typing.BinaryIO) -> bytes:
+    with zipfile.ZipFile(source) as zip:
+        return zip.read(zip.namelist()[0])
+
+
+def run_interval(interval: t_interval, days: int, now: datetime, stand_in: StandInServer, dao: KlineStorage, base_dir: str, download_workers: int, prefetch_depth: int) -> typing.Dict[str, typing.Dict[str, float]]:
+    timers = {stage: StageTimer() for stage in STAGES}
+    market, symbol = "spot", "BENCHUSDT"
+    days_list = [Cursor.fromtimestamp((now - timedelta(days=day)).timestamp(), tz=UTC) for day in range(days, 0, -1)]
+
+    # the archives are generated before the measurements
+    for day in days_list:
+        for archive_symbol in (symbol, "BENCHE2E"):
+            stand_in.get_archive(urlsplit(build_url(symbol=archive_symbol, interval=interval, market=market, cursor=day)).path)
+
+    downloads = [timers["download"].measure(lambda: download_zip(build_url(symbol=symbol, interval=interval, market=market, cursor=day))[0]) for day in days_list]
+
+    batches = []
+    for source in downloads:
+        timers["unzip"].measure(lambda: read_zip(source))
+        # unzip and csv parse are streamed together in the ingest path
+        chunks = timers["csv_parse"].measure(lambda: list(iter_csv_chunks(zip_source=source)), rows=lambda chunks: sum(len(chunk) for chunk in chunks))
+        timers["unzip"].rows += sum(len(chunk) for chunk in chunks)
+        timers["download"].rows += sum(len(chunk) for chunk in chunks)
+
+        for chunk in chunks:
+            batches.append(timers["ohlcv_batch"].measure(lambda: OHLCVBatch.from_raw(raw_data=chunk), rows=len(chunk)))
+            timers["ohlcv_models"].measure(lambda: OHLCV.init_from_list(raw_data=chunk), rows=len(chunk))
+
+    for batch in batches:
+        timers["insert"].measure(lambda: dao.insert_klines_error_resistant(market=market, symbol=symbol, interval=interval, klines=batch), rows=len(batch))
+    for batch in batches:
+        timers["reinsert"].measure(lambda: dao.insert_klines_error_resistant(market=market, symbol=symbol, interval=interval, klines=batch), rows=len(batch))
+
+    # full pipeline of a fresh symbol: start cursor through the rest api, monthly / daily archives, writer
+    writer = KlineWriter(dao=dao, batch_size=50_000, queue_size=16)
+    def end_to_end():
+        fetch_and_store_klines(symbol="BENCHE2E", interval=interval, market=market, base_dir=base_dir, dao=dao, writer=writer, zip_cache=None,
+                               download_workers=download_workers, prefetch_depth=prefetch_depth)
+        writer.close()
+    timers["end_to_end"].measure(end_to_end, rows=lambda _: sum(report.inserted + report.skipped for report in writer.reports.values()))
+
+    return {stage: timer.summary() for stage, timer in timers.items()}
+
+
+def compare(results: typing.Dict, baseline: typing.Dict, max_regression: float) -> bool:
+    # prints the rows per second change of every stage. returns False if a stage is slower than allowed
+    ok = True
+    logging.warning(f"comparing with {baseline.get('commit')} ({baseline.get('created_at')})")
+    if baseline.get("config") != results["config"]:
+        logging.warning(f"the baseline was run with a different configuration: {baseline.get('config')}")
+    for interval, stages in results["results"].items():
+        for stage, summary in stages.items():
+            before = baseline.get("results", {}).get(interval, {}).get(stage, {}).get("rows_per_second")
+            if not before:
+                continue
+            change = summary["rows_per_second"] / before - 1
+            regression = change < -max_regression
+            ok &= not regression
+            log = logging.error if regression else logging.warning
+            log(f"{interval:>3} {stage:<13} {before:>14.1f} -> {summary['rows_per_second']:>14.1f} rows/s ({change:+.1%}){' REGRESSION' if regression else ''}")
+    return ok
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return None
+
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description="offline benchmark of the ingest path against a local Binance stand-in", usage="python benchmark.py -h")
+    parser.add_argument("--intervals", dest="intervals", nargs="+", default=BENCHMARK_INTERVALS, choices=list(typing.get_args(t_spot_interval)))
+    parser.add_argument("--days", dest="days", default=3, type=int, help="daily archives per interval")
+    parser.add_argument("--storage", dest="storage", default="memory", choices=["memory", "parquet", "mongo"], help="`memory` is an in-process stand-in. `mongo` drops and uses the benchmark_* databases of `--mongo-uri`")
+    parser.add_argument("--mongo-uri", dest="mongo_uri", default="mongodb://localhost:27017")
+    parser.add_argument("--download-workers", dest="download_workers", default=4, type=int)
+    parser.add_argument("--prefetch-depth", dest="prefetch_depth", default=8, type=int)
+    parser.add_argument("--output", dest="output", default="bench_output.json", help="json file the results are written to")
+    parser.add_argument("--compare", dest="compare", default=None, help="results of an earlier run. exits with 1 if a stage regressed by more than `--max-regression`")
+    parser.add_argument("--max-regression", dest="max_regression", default=0.2, type=float, metavar="0.2")
+    parser.add_argument("--log-level", dest="log_level", default="warning", choices=list(typing.get_args(t_log_level)))
+    return parser.parse_args(argv)
+
+
+def main(argv = None) -> int:
+    args = parse_args(argv)
+    coloredlogs.install(level=args.log_level)
+
+    # synthetic klines end with yesterday, the day the harvester stops at
+    now = datetime.now(tz=UTC).replace(hour=0, minute=0, second=0, microsecond=0)
+    start = now - timedelta(days=args.days)
+    stand_in = StandInServer(SyntheticKlines(start=int(start.timestamp() * 1000), end=int(now.timestamp() * 1000)))
+    HttpClient.configure(base_url_overrides={host: stand_in.url for host in STAND_IN_HOSTS})
+
+    results = {
+        "commit": get_commit(),
+        "created_at": datetime.now(tz=UTC).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "mongo_uri")},
+        "results": {},
+    }
+
+    try:
+        with tempfile.TemporaryDirectory(prefix="benchmark-") as base_dir:
+            dao = create_benchmark_storage(storage=args.storage, mongo_uri=args.mongo_uri, base_dir=base_dir)
+            for interval in args.intervals:
+                logging.warning(f"benchmarking {interval}...")
+                results["results"][interval] = run_interval(interval=interval, days=args.days, now=now, stand_in=stand_in, dao=dao, base_dir=base_dir,
+                                                            download_workers=args.download_workers, prefetch_depth=args.prefetch_depth)
+                for stage, summary in results["results"][interval].items():
+                    logging.warning(f"{interval:>3} {stage:<13} {summary['rows']:>9} rows {summary['rows_per_second']:>14.1f} rows/s  p50 {summary['latency_ms_p50']:>9.3f} ms  p95 {summary['latency_ms_p95']:>9.3f} ms")
+    finally:
+        stand_in.close()
+
+    with open(args.output, "w") as fp:
+        json.dump(results, fp, indent=2)
+    logging.warning(f"results written to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare, "r") as fp:
+            if not compare(results=results, baseline=json.load(fp), max_regression=args.max_regression):
+                return 1
+    return 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+import logging, time, typing
+import xml.etree.ElementTree as ET
+from datetime import datetime, UTC, timedelta
+from urllib.parse import quote
+from pydantic import BaseModel
+from lib.DataStructures import ArchiveFile
+from lib.utility import TTLJsonCache
+from lib.Types import *
+from lib import HttpClient
+
+
+# data.binance.vision is served from this S3 bucket. the bucket listing returns up to 1000 keys per request
+LISTING_URL = "https://s3-ap-northeast-1.amazonaws.com/data.binance.vision"
+LISTING_NAMESPACE = {"s3": "http://s3.amazonaws.com/doc/2006-03-01/"}
+DEFAULT_LISTING_TTL = 6 * 3600
+# archives ending less than LISTING_PUBLICATION_LAG before a listing was taken may have been published after it.
+# they are requested even if they are not listed
+LISTING_PUBLICATION_LAG = timedelta(days=2)
+
+
+class ArchiveListing(BaseModel):
+    fetched_at: float
+    files: typing.Dict[str, int]  # archive date (YYYY-MM or YYYY-MM-DD) -> size in bytes
+
+
+def build_listing_prefix(symbol: str, interval: t_interval, market: t_market, period: t_period) -> str:
+    market = f"futures/{market}" if market in ("um", "cm") else market
+    return f"data/{market}/{period}/klines/{symbol}/{interval}/"
+
+
+class ArchiveListingCache:
+    # the published archives of a symbol and interval, listed with a few paginated bucket listing requests instead of
+    # requesting every day and catching 404s. listings are kept in memory and as a json file per market, period, symbol
+    # and interval in `cache_dir`, they are listed again after `ttl` seconds
+    def __init__(self, cache_dir: str | None = None, ttl: float = DEFAULT_LISTING_TTL):
+        self._cache = TTLJsonCache(ArchiveListing, cache_dir=cache_dir, ttl=ttl)
+
+
+    @staticmethod
+    def _fetch(symbol: str, interval: t_interval, market: t_market, period: t_period) -> ArchiveListing:
+        prefix = build_listing_prefix(symbol=symbol, interval=interval, market=market, period=period)
+        fetched_at = time.time()
+        files, marker, n_requests = {}, "", 0
+        while True:
+            res = HttpClient.get_http_client().get(f"{LISTING_URL}?delimiter=/&prefix={quote(prefix)}&marker={quote(marker)}", symbol=symbol)
+            root = ET.fromstring(res.content)
+            n_requests += 1
+
+            keys = []
+            for content in root.iterfind("s3:Contents", LISTING_NAMESPACE):
+                key = content.findtext("s3:Key", namespaces=LISTING_NAMESPACE)
+                keys.append(key)
+                if key.endswith(".zip"):
+                    # {symbol}-{interval}-{date}.zip
+                    files[key[len(prefix) + len(symbol) + len(interval) + 2:-4]] = int(content.findtext("s3:Size", namespaces=LISTING_NAMESPACE))
+
+            if root.findtext("s3:IsTruncated", namespaces=LISTING_NAMESPACE) != "true" or not keys:
+                break
+            marker = root.findtext("s3:NextMarker", namespaces=LISTING_NAMESPACE) or keys[-1]
+
+        logging.info(f"{len(files)} {period} archives listed with {n_requests} requests. symbol: {symbol} interval: {interval} market: {market}")
+        return ArchiveListing(fetched_at=fetched_at, files=files)
+
+
+    def get_listing(self, symbol: str, interval: t_interval, market: t_market, period: t_period) -> ArchiveListing:
+        key = f"{market}_{period}_{symbol}_{interval}"
+        listing = self._cache.get(key)
+        if not self._cache.is_fresh(listing):
+            listing = self._fetch(symbol=symbol, interval=interval, market=market, period=period)
+            self._cache.put(key, listing)
+        return listing
+
+
+    def get_size(self, symbol: str, interval: t_interval, market: t_market, archive: ArchiveFile) -> int | None:
+        listing = self.get_listing(symbol=symbol, interval=interval, market=market, period=archive.period)
+        return listing.files.get(archive.get_date())
+
+
+    def filter_plan(self, symbol: str, interval: t_interval, market: t_market, plan: typing.List[ArchiveFile]) -> typing.Tuple[typing.List[ArchiveFile], typing.List[ArchiveFile]]:
+        # splits the plan into the archives to download and the daily archives that are not published.
+        # an unlisted monthly archive is replaced by the listed daily archives of the month
+        listings: typing.Dict[str, ArchiveListing] = {}
+        planned, unlisted = [], []
+        for archive in plan:
+            if archive.period not in listings:
+                listings[archive.period] = self.get_listing(symbol=symbol, interval=interval, market=market, period=archive.period)
+            listing = listings[archive.period]
+
+            if archive.get_date() in listing.files or archive.get_end() + LISTING_PUBLICATION_LAG > datetime.fromtimestamp(listing.fetched_at, tz=UTC):
+                planned.append(archive)
+            elif archive.period == "monthly":
+                days_planned, days_unlisted = self.filter_plan(symbol=symbol, interval=interval, market=market, plan=archive.get_days())
+                planned += days_planned
+                unlisted += days_unlisted
+            else:
+                unlisted.append(archive)
+        return planned, unlisted
@@ -1,30 +1,82 @@
 import os, argparse, typing
-from pydantic import BaseModel
+from pydantic import BaseModel, model_validator
 from dotenv import dotenv_values
 from lib.utility import *
 from lib.Types import *
+from lib import SymbolMetadata, HttpClient
+from lib.Resample import check_resample_interval
 
 
 class EnvConfiguration(BaseModel):
-    MONGO_URI: str
+    STORAGE_BACKEND: t_storage_backend = "mongo"
 
-    binance_spot_klines_db: str
-    binance_um_klines_db: str
-    binance_cm_klines_db: str
+    MONGO_URI: str | None = None
+
+    binance_spot_klines_db: str | None = None
+    binance_um_klines_db: str | None = None
+    binance_cm_klines_db: str | None = None
 
     BASE_DIR: str
+    PARQUET_DIR: str | None = None  # defaults to BASE_DIR/parquet
+
+
+    @model_validator(mode="after")
+    def check_storage_backend_keys(self):
+        if self.STORAGE_BACKEND == "mongo":
+            missing = [key for key in MONGO_ENV_KEYS if not getattr(self, key)]
+            if missing:
+                raise ValueError(f"missing keys for storage backend mongo: {', '.join(missing)}")
+        return self
+
+
+MONGO_ENV_KEYS = ["MONGO_URI", "binance_spot_klines_db", "binance_um_klines_db", "binance_cm_klines_db"]
 
 
 class Configuration(BaseModel): 
     env_config: EnvConfiguration
 
+    command: t_command
+
     
     symbols: typing.List[str]
     market: str
-    interval: str
+    interval: str | None
+    data_type: t_data_type
 
     log_level: t_log_level
     use_zip_cache: bool
+    zip_cache_size: int | None
+    zip_cache_max_age: int | None
+    use_manifest: bool
+    use_listing: bool
+    dry_run: bool
+
+    use_monthly_archives: bool
+    symbol_workers: int
+    download_workers: int
+    prefetch_depth: int
+
+    write_batch_size: int
+    write_queue_size: int
+    write_concern: str
+    time_series: bool
+
+    fill_gaps: bool
+    resample_intervals: typing.List[str]
+
+    follow: bool
+    top_up: bool
+    follow_spread: int
+
+    http_pool_size: int
+    http_retries: int
+    http_timeout: float
+
+    metadata_ttl: int
+    metrics_file: str | None
+    metrics_interval: int
+    profile: str | None
+    offline_metadata: bool
 
 
 
@@ -37,7 +89,8 @@ def check_env_config(path: str):
     except Exception as e:
         raise argparse.ArgumentTypeError(f"error loading the environment file {path}. error: {e}")
     
-    missing = [env_key for env_key in list(EnvConfiguration.model_fields.keys()) if not config.get(env_key)]
+    config = {env_key: value for env_key, value in config.items() if value}
+    missing = [env_key for env_key, field in EnvConfiguration.model_fields.items() if field.is_required() and not config.get(env_key)]
     if missing: 
         raise argparse.ArgumentTypeError(f"error loading the environment file {path}. missing keys: {', '.join(missing)}")
     
@@ -58,9 +111,12 @@ def check_symbols(symbols: typing.List[str], market: t_market) -> typing.List[st
     if symbols == None:
         return []
 
-    binance_symbols = Binance.get_all_symbols(market=market)
+    try:
+        symbol_metadata = SymbolMetadata.get_symbol_metadata()
+        invalid = [symbol for symbol in symbols if not symbol_metadata.is_valid(symbol=symbol, market=market)]
+    except Exception as e:
+        raise argparse.ArgumentTypeError(f"could not load the exchange info to validate the symbols: {e}")
 
-    invalid = [symbol for symbol in symbols if symbol not in binance_symbols]
     if invalid: 
         raise argparse.ArgumentTypeError(f"invalid symbols found: {', '.join(invalid)}")
     return symbols
@@ -81,6 +137,68 @@ def check_market_compatibility(market: t_market, interval: t_interval):
     return market
 
 
+def check_resample_intervals(resample_intervals: typing.List[str] | None, market: t_market, interval: t_interval, command: t_command) -> typing.List[str]:
+    if command != "resample":
+        return []
+    if not resample_intervals:
+        raise argparse.ArgumentTypeError("the resample command requires the target intervals. e.g. `--resample-intervals 5m 1h 1d`")
+
+    for resample_interval in resample_intervals:
+        check_market_compatibility(market, resample_interval)
+        try:
+            check_resample_interval(interval=interval, target_interval=resample_interval)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+    return resample_intervals
+
+
+def check_non_negative_int(value: str) -> int:
+    try:
+        value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid integer value: {value}")
+    
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"value must be greater than or equal to 0. provided: {value}")
+    return value
+
+
+def check_positive_int(value: str) -> int:
+    try:
+        value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid integer value: {value}")
+    
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"value must be greater than or equal to 1. provided: {value}")
+    return value
+
+
+def check_positive_float(value: str) -> float:
+    try:
+        value = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid float value: {value}")
+    
+    if not value > 0:
+        raise argparse.ArgumentTypeError(f"value must be greater than 0. provided: {value}")
+    return value
+
+
+def check_size(value: str) -> int:
+    # bytes with an optional K / M / G / T suffix (powers of 1024)
+    units = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+    multiplier = units.get(value[-1:].upper(), 1)
+    try:
+        size = float(value[:-1] if multiplier != 1 else value) * multiplier
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {value}. examples: 500M, 50G, 2T")
+    
+    if size < 1:
+        raise argparse.ArgumentTypeError(f"size must be greater than 0. provided: {value}")
+    return int(size)
+
+
 def parse_args(argv = None) -> Configuration:
     parser = argparse.ArgumentParser(
         description="Binance Kline Data Harvester by cr4k4nx",
@@ -88,6 +206,15 @@ def parse_args(argv = None) -> Configuration:
     )
 
 
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="harvest",
+        choices=list(typing.get_args(t_command)),
+        help="`harvest` downloads the daily / monthly archives (default). `gaps` scans the stored klines for missing ranges and fills them through the rest api. `resample` builds coarser intervals from the stored `--interval` klines. `normalize` converts stored klines with second or microsecond timestamps to milliseconds"
+    )
+
+
     parser.add_argument(
         "--market",
         required=True,
@@ -108,9 +235,20 @@ def parse_args(argv = None) -> Configuration:
 
     parser.add_argument(
         "--interval",
-        required=True,
+        required=False,
+        default=None,
         dest="interval",
         choices=set(typing.get_args(t_spot_interval) + typing.get_args(t_um_interval) + typing.get_args(t_cm_interval)),
+        help="kline interval. required for klines"
+    )
+
+
+    parser.add_argument(
+        "--data-type",
+        dest="data_type",
+        default="klines",
+        choices=list(typing.get_args(t_data_type)),
+        help="*OPTIONAL* `klines` (default) or the `trades` / `aggTrades` archives. trades are streamed block by block and continue after the newest stored trade id. `harvest` and `--follow` only"
     )
 
 
@@ -119,7 +257,7 @@ def parse_args(argv = None) -> Configuration:
         dest="env_file",
         default="./.env",
         metavar="./.env",
-        help=f"Path to environment file containing your desired database and storage configuration. required keys: {', '.join(list(EnvConfiguration.model_fields.keys()))}"
+        help=f"Path to environment file containing your desired database and storage configuration. keys: {', '.join(list(EnvConfiguration.model_fields.keys()))}. the MongoDB keys are required for STORAGE_BACKEND=mongo (default)"
     )
 
 
@@ -137,18 +275,297 @@ def parse_args(argv = None) -> Configuration:
         dest="use_zip_cache",
         default=False,
         action=argparse.BooleanOptionalAction,
-        help="use already downloaded .zip files instead of downloading them again"
+        help="keep downloaded .zip files and use them instead of downloading them again. cached files are verified once against the published .CHECKSUM files"
+    )
+
+    parser.add_argument(
+        "--zip-cache-size", 
+        dest="zip_cache_size",
+        default=None,
+        type=check_size,
+        metavar="50G",
+        help="*OPTIONAL* size budget of the zip cache. the least recently used zips are deleted when it is exceeded. unlimited by default"
+    )
+
+    parser.add_argument(
+        "--zip-cache-max-age", 
+        dest="zip_cache_max_age",
+        default=None,
+        type=check_positive_int,
+        metavar="30",
+        help="*OPTIONAL* days after which unused zips are deleted from the zip cache. kept forever by default"
+    )
+
+    parser.add_argument(
+        "--use-manifest", 
+        dest="use_manifest",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+        help="*OPTIONAL* keep track of ingested and missing archives in BASE_DIR/manifest.sqlite3 and skip them on later runs. failed archives are retried. use `--no-use-manifest` after deleting stored klines"
+    )
+
+
+    parser.add_argument(
+        "--use-listing", 
+        dest="use_listing",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+        help="*OPTIONAL* list the published archives of every symbol (cached in BASE_DIR/listings) and plan the downloads from the listing instead of requesting unpublished days. use `--no-use-listing` if the bucket listing is not reachable"
+    )
+
+    parser.add_argument(
+        "--dry-run", 
+        dest="dry_run",
+        default=False,
+        action="store_true",
+        help="*OPTIONAL* `harvest` only: show the planned archives, their total size and the estimated download time without downloading anything"
+    )
+
+
+    parser.add_argument(
+        "--use-monthly-archives", 
+        dest="use_monthly_archives",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+        help="*OPTIONAL* download completed months as a single monthly archive. falls back to the daily archives if the monthly archive is not published (yet)"
+    )
+
+
+    parser.add_argument(
+        "--symbol-workers", 
+        dest="symbol_workers",
+        default=1,
+        type=check_positive_int,
+        metavar="1",
+        help="*OPTIONAL* number of symbols harvested concurrently. all symbols share one rate limiter per host"
+    )
+
+
+    parser.add_argument(
+        "--download-workers", 
+        dest="download_workers",
+        default=4,
+        type=check_positive_int,
+        metavar="4",
+        help="*OPTIONAL* number of worker threads downloading archives concurrently"
+    )
+
+
+    parser.add_argument(
+        "--prefetch-depth", 
+        dest="prefetch_depth",
+        default=8,
+        type=check_positive_int,
+        metavar="8",
+        help="*OPTIONAL* maximum number of archives downloaded ahead of the database insert stage"
+    )
+
+    parser.add_argument(
+        "--write-batch-size", 
+        dest="write_batch_size",
+        default=50_000,
+        type=check_positive_int,
+        metavar="50000",
+        help="*OPTIONAL* number of klines merged into a single database write. batches of consecutive days are merged until this size is reached"
+    )
+
+
+    parser.add_argument(
+        "--write-queue-size", 
+        dest="write_queue_size",
+        default=16,
+        type=check_positive_int,
+        metavar="16",
+        help="*OPTIONAL* maximum number of parsed batches waiting for the database writer. downloads are paused while the queue is full"
+    )
+
+
+    parser.add_argument(
+        "--write-concern", 
+        dest="write_concern",
+        default="1",
+        metavar="1",
+        help="*OPTIONAL* STORAGE_BACKEND=mongo only. MongoDB write concern `w` used for all inserts, e.g. 0, 1, majority"
+    )
+
+    parser.add_argument(
+        "--time-series", 
+        dest="time_series",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="*OPTIONAL* STORAGE_BACKEND=mongo only. create new kline collections as MongoDB time series collections (MongoDB 6.3+). existing collections keep their type"
+    )
+
+    parser.add_argument(
+        "--fill-gaps", 
+        dest="fill_gaps",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+        help="*OPTIONAL* `gaps` command only. fill the found gaps through the rest api. `--no-fill-gaps` only reports them"
+    )
+
+    parser.add_argument(
+        "--resample-intervals", 
+        dest="resample_intervals",
+        nargs="+",
+        metavar="1h",
+        choices=set(typing.get_args(t_spot_interval) + typing.get_args(t_um_interval) + typing.get_args(t_cm_interval)),
+        help="`resample` command only. intervals built from the stored `--interval` klines. each must be a multiple of `--interval`, e.g. `--interval 1m --resample-intervals 5m 15m 1h 4h 1d`"
+    )
+
+
+    parser.add_argument(
+        "--follow", 
+        dest="follow",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="*OPTIONAL* `harvest` command only. keep running and harvest every new daily archive after Binance published it instead of stopping after yesterday"
+    )
+
+
+    parser.add_argument(
+        "--top-up", 
+        dest="top_up",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="*OPTIONAL* `--follow` only. keep the current day topped up through the rest api after every closed interval (at most once per minute)"
+    )
+
+
+    parser.add_argument(
+        "--follow-spread", 
+        dest="follow_spread",
+        default=3600,
+        type=check_positive_int,
+        metavar="3600",
+        help="*OPTIONAL* `--follow` only. seconds over which the daily harvests of all symbols are spread after the archives are published"
+    )
+
+    parser.add_argument(
+        "--http-pool-size", 
+        dest="http_pool_size",
+        default=32,
+        type=check_positive_int,
+        metavar="32",
+        help="*OPTIONAL* maximum number of keep-alive connections per host shared by all download threads"
+    )
+
+
+    parser.add_argument(
+        "--http-retries", 
+        dest="http_retries",
+        default=5,
+        type=check_non_negative_int,
+        metavar="5",
+        help="*OPTIONAL* number of retries with exponential backoff for dropped connections, 418, 429 and 5xx responses"
+    )
+
+
+    parser.add_argument(
+        "--http-timeout", 
+        dest="http_timeout",
+        default=60.0,
+        type=check_positive_float,
+        metavar="60",
+        help="*OPTIONAL* read timeout in seconds for all http requests"
+    )
+
+    parser.add_argument(
+        "--metadata-ttl", 
+        dest="metadata_ttl",
+        default=SymbolMetadata.DEFAULT_TTL,
+        type=check_positive_int,
+        metavar=str(SymbolMetadata.DEFAULT_TTL),
+        help="*OPTIONAL* seconds the exchange info (symbols, onboard dates) cached in BASE_DIR/metadata is used before it is downloaded again. a stale copy is used if binance is slow or unreachable"
+    )
+
+
+    parser.add_argument(
+        "--offline-metadata", 
+        dest="offline_metadata",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="*OPTIONAL* never download the exchange info and validate the symbols against the cached copy only"
+    )
+
+    parser.add_argument(
+        "--metrics-file", 
+        dest="metrics_file",
+        default=None,
+        metavar="metrics.json",
+        help="*OPTIONAL* write timings and counters of every stage (download, unzip, parse, insert, http) per symbol and run to this file. `*.prom` files are written in the prometheus text format, all others as json"
+    )
+
+
+    parser.add_argument(
+        "--metrics-interval", 
+        dest="metrics_interval",
+        default=60,
+        type=int,
+        metavar="60",
+        help="*OPTIONAL* seconds between two writes of `--metrics-file` during the run. 0 writes the metrics only at the end"
+    )
+
+
+    parser.add_argument(
+        "--profile", 
+        dest="profile",
+        default=None,
+        metavar="harvest.prof",
+        help="*OPTIONAL* profile the hot path (unzip, csv parse, insert) with cProfile and write the stats to this file"
     )
 
     # parse the args... 
     args = parser.parse_args(argv)
 
     # validate the args...
+    if args.data_type == "klines" and args.interval is None:
+        parser.error("the following arguments are required for klines: --interval")
+    if args.data_type != "klines" and (args.command != "harvest" or args.top_up or args.dry_run):
+        parser.error(f"{args.data_type} support the `harvest` command only, without `--top-up` and `--dry-run`")
+
+    env_config = check_env_config(args.env_file)
+    # the symbols are validated against the exchange info, already through the configured http client
+    HttpClient.configure(pool_size = args.http_pool_size, 
+                         max_retries = args.http_retries, 
+                         read_timeout = args.http_timeout)
+    SymbolMetadata.configure(cache_dir = os.path.join(env_config.BASE_DIR, "metadata"), 
+                             ttl = args.metadata_ttl, 
+                             offline = args.offline_metadata)
+
     return Configuration(
-        env_config=check_env_config(args.env_file),
-        market=check_market_compatibility(args.market, args.interval), 
+        env_config=env_config,
+        command=args.command,
+        market=check_market_compatibility(args.market, args.interval) if args.interval is not None else args.market, 
         interval=args.interval,
+        data_type=args.data_type,
         symbols = check_symbols(args.symbols, args.market),
         log_level = args.log_level,
         use_zip_cache = args.use_zip_cache,
+        zip_cache_size = args.zip_cache_size,
+        zip_cache_max_age = args.zip_cache_max_age,
+        use_manifest = args.use_manifest,
+        use_listing = args.use_listing,
+        dry_run = args.dry_run,
+        use_monthly_archives = args.use_monthly_archives,
+        symbol_workers = args.symbol_workers,
+        download_workers = args.download_workers,
+        prefetch_depth = args.prefetch_depth,
+        write_batch_size = args.write_batch_size,
+        write_queue_size = args.write_queue_size,
+        write_concern = args.write_concern,
+        time_series = args.time_series,
+        fill_gaps = args.fill_gaps,
+        resample_intervals = check_resample_intervals(args.resample_intervals, args.market, args.interval, args.command),
+        follow = args.follow,
+        top_up = args.top_up,
+        follow_spread = args.follow_spread,
+        http_pool_size = args.http_pool_size,
+        http_retries = args.http_retries,
+        http_timeout = args.http_timeout,
+        metadata_ttl = args.metadata_ttl,
+        metrics_file = args.metrics_file,
+        metrics_interval = args.metrics_interval,
+        profile = args.profile,
+        offline_metadata = args.offline_metadata,
     )
\ No newline at end of file
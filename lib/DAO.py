@@ -1,17 +1,93 @@
-import logging, pymongo, typing, uuid
-from pymongo.errors import DuplicateKeyError, BulkWriteError
-from lib.DataStructures import OHLCV
+import logging, pymongo, typing, uuid, threading, bson
+from pymongo.errors import BulkWriteError, CollectionInvalid, OperationFailure
+from pymongo.operations import DeleteOne, UpdateOne
+from pymongo.write_concern import WriteConcern
+import numpy as np
+from lib.DataStructures import OHLCV, OHLCVBatch, InsertReport, KLINE_DTYPE, TRADE_ID_FIELDS, TRADE_TIME_FIELDS, get_fields_dtype
+from lib.Storage import KlineStorage
 from lib.Types import *
 from lib.utility import *
 
-class DAO:
-    def __init__(self, uri, SPOT_KLINE_DB: str, UM_KLINE_DB: str, CM_KLINE_DB: str):
+
+READ_BATCH_SIZE = 100_000
+MIGRATION_BATCH_SIZE = 10_000
+# server error code of create_collection if the collection already exists
+NAMESPACE_EXISTS = 48
+
+TIME_SERIES_TIME_FIELD = "timestamp"
+TIME_SERIES_META_FIELD = "symbol"
+TIME_SERIES_GRANULARITY: typing.Dict[str, str] = {
+    "1s": "seconds",
+    "1m": "minutes", "3m": "minutes", "5m": "minutes", "15m": "minutes", "30m": "minutes",
+    "1h": "hours", "2h": "hours", "4h": "hours", "6h": "hours", "8h": "hours", "12h": "hours", "1d": "hours",
+}
+
+
+# fixed size bson element types: double, int32, int64, datetime
+BSON_NUMERIC_TYPES: typing.Dict[int, str] = {0x01: "<f8", 0x10: "<i4", 0x12: "<i8", 0x09: "<i8"}
+
+
+def _get_raw_layout(batch: bytes, size: int) -> typing.Tuple[typing.Dict[str, typing.Tuple[str, int]], typing.List[int]] | None:
+    # field name -> (numpy dtype, value offset) of the first document and the byte positions that are not values. 
+    # None if the document contains other than fixed size numeric fields
+    layout, fixed_positions, offset = {}, list(range(4)), 4
+    while offset < size - 1:
+        element_type = BSON_NUMERIC_TYPES.get(batch[offset])
+        if element_type is None:
+            return None
+        
+        value_offset = batch.index(b"\x00", offset + 1) + 1
+        layout[batch[offset + 1:value_offset - 1].decode()] = (element_type, value_offset)
+        fixed_positions += range(offset, value_offset)
+        offset = value_offset + np.dtype(element_type).itemsize
+    return layout, fixed_positions + [size - 1]
+
+
+def decode_raw_batch(batch: bytes, dtype: np.dtype) -> np.ndarray:
+    # decodes a raw bson batch of projected kline documents into the columns of `dtype`. the documents of a batch usually share
+    # one layout (same fields, order and numeric types). then the batch is viewed as a byte matrix and every field is read at its 
+    # offset without creating a python object per document. batches with mixed layouts are decoded with bson.decode_all
+    size = int.from_bytes(batch[:4], "little")
+    raw_layout = _get_raw_layout(batch=batch, size=size) if size and len(batch) % size == 0 else None
+
+    if raw_layout is not None:
+        layout, fixed_positions = raw_layout
+        matrix = np.frombuffer(batch, dtype=np.uint8).reshape(-1, size)
+        fixed_mask = np.zeros(size, dtype=np.uint8)
+        fixed_mask[fixed_positions] = 0xFF
+        if not ((matrix ^ matrix[0]) & fixed_mask).any():
+            columns = np.zeros(len(matrix), dtype=dtype)
+            for name in dtype.names:
+                if name in layout:
+                    element_type, value_offset = layout[name]
+                    columns[name] = matrix[:, value_offset:value_offset + np.dtype(element_type).itemsize].copy().view(element_type)[:, 0]
+            return columns
+
+    documents = bson.decode_all(batch)
+    columns = np.empty(len(documents), dtype=dtype)
+    for name in dtype.names:
+        # time series collections do not store the ignore field
+        columns[name] = np.fromiter((d.get(name, 0) for d in documents), dtype=dtype[name], count=len(documents))
+    return columns
+
+
+class DAO(KlineStorage):
+    # MongoDB storage backend
+    def __init__(self, uri, SPOT_KLINE_DB: str, UM_KLINE_DB: str, CM_KLINE_DB: str, write_concern: str = "1", time_series: bool = False, read_only: bool = False):
         logging.info("initializing MongoDB client using the provided connection string...")
         self.client = pymongo.MongoClient(uri)
+        self.write_concern = WriteConcern(w=int(write_concern) if write_concern.isdigit() else write_concern)
 
         self.spot_kline_db = SPOT_KLINE_DB
         self.um_kline_db = UM_KLINE_DB
         self.cm_kline_db = CM_KLINE_DB
+        self.time_series = time_series
+        # --dry-run: collections are accessed as they are, missing collections and indexes are not created
+        self.read_only = read_only
+
+        self._collections: typing.Dict[typing.Tuple[str, str], pymongo.collection.Collection] = {}
+        self._collections_lock = threading.Lock()
+        self._time_series_collections: typing.Set[typing.Tuple[str, str]] = set()
         logging.info("MongoDB client successfully established connection")
 
     def _generate_kline_collection_name(self, market: t_market, symbol: str, interval: t_interval):
@@ -27,75 +103,204 @@ class DAO:
         return db, coll
     
 
-    def _get_collection(self, database_name: str, collection_name: str):
-        logging.info(f"accessing collection {collection_name} in database {database_name}...")
-        db = self.client.get_database(database_name)
+    def _get_collection(self, database_name: str, collection_name: str, interval: t_interval):
+        # the collection handles are cached per process. existence check and index creation run only once per collection
+        key = (database_name, collection_name)
+        collection = self._collections.get(key)
+        if collection is not None:
+            return collection
+        
+        if self.read_only:
+            return self.client.get_database(database_name).get_collection(collection_name)
 
-        if collection_name not in db.list_collection_names():
-            logging.info(f"collection {collection_name} does not exists in database {database_name}")
-            logging.info("creating collection...")
+        with self._collections_lock:
+            if key in self._collections:
+                return self._collections[key]
             
-            collection = db.create_collection(name=collection_name)
-            collection.create_index([("open_time", pymongo.ASCENDING)], unique=True)
+            logging.info(f"accessing collection {collection_name} in database {database_name}...")
+            db = self.client.get_database(database_name)
+
+            info = next(db.list_collections(filter={"name": collection_name}), None)
+            if info is None:
+                logging.info(f"collection {collection_name} does not exists in database {database_name}")
+                logging.info(f"creating {'time series ' if self.time_series else ''}collection...")
+                
+                try:
+                    if self.time_series:
+                        db.create_collection(name=collection_name, timeseries={
+                            "timeField": TIME_SERIES_TIME_FIELD, 
+                            "metaField": TIME_SERIES_META_FIELD, 
+                            "granularity": TIME_SERIES_GRANULARITY[interval],
+                        })
+                    else:
+                        db.create_collection(name=collection_name)
+                    logging.info("collection created")
+                except (CollectionInvalid, OperationFailure) as e:
+                    # another harvester process created the collection in the meantime. the server reports the race
+                    # as NamespaceExists (code 48), the client only raises CollectionInvalid if it saw the collection itself
+                    if isinstance(e, OperationFailure) and e.code != NAMESPACE_EXISTS:
+                        raise e
+                    logging.info(f"collection {collection_name} was created concurrently")
+                info = next(db.list_collections(filter={"name": collection_name}), {})
             
-            logging.info("collection created")
+            # the actual type of an existing collection wins over the configured storage mode
+            if info.get("type") == "timeseries":
+                self._time_series_collections.add(key)
 
+            # idempotent. makes sure the index also exists if a concurrent process has not created it yet
+            # time series collections do not support unique indexes. duplicates are filtered by insert_klines_error_resistant
+            collection = db.get_collection(collection_name, write_concern=self.write_concern)
+            collection.create_index([("open_time", pymongo.ASCENDING)], unique=key not in self._time_series_collections)
 
-        collection = db.get_collection(collection_name)
-        return collection
+            self._collections[key] = collection
+            return collection
     
 
     def _get_kline_collection(self, market: t_market, symbol: str, interval: t_interval): 
         db_name, coll_name = self._generate_kline_collection_name(market=market, symbol=symbol, interval=interval)
-        return self._get_collection(database_name=db_name, collection_name=coll_name)
+        return self._get_collection(database_name=db_name, collection_name=coll_name, interval=interval)
+
+
+    def _get_trade_collection(self, market: t_market, symbol: str, trade_type: t_trade_type):
+        # {symbol}_trades / {symbol}_aggTrades in the kline database of the market. always regular collections, unique per trade id
+        key = self._generate_kline_collection_name(market=market, symbol=symbol, interval=trade_type)
+        collection = self._collections.get(key)
+        if collection is not None:
+            return collection
+
+        with self._collections_lock:
+            if key not in self._collections:
+                logging.info(f"accessing collection {key[1]} in database {key[0]}...")
+                collection = self.client.get_database(key[0]).get_collection(key[1], write_concern=self.write_concern)
+                collection.create_index([(TRADE_ID_FIELDS[trade_type], pymongo.ASCENDING)], unique=True)
+                self._collections[key] = collection
+            return self._collections[key]
+
+
+    def _is_time_series(self, collection: pymongo.collection.Collection) -> bool:
+        return (collection.database.name, collection.name) in self._time_series_collections
+
+
+    def _to_documents(self, collection: pymongo.collection.Collection, symbol: str, klines: OHLCVBatch) -> typing.List[typing.Dict]:
+        documents = klines.to_documents()
+        if not self._is_time_series(collection):
+            return documents
+        
+        # time series: bson date of the open_time as time field, the symbol as bucket meta data and no `ignore`
+        timestamps = unix_ts_to_datetime64(klines.open_time).tolist()
+        for document, timestamp in zip(documents, timestamps):
+            del document["ignore"]
+            document[TIME_SERIES_TIME_FIELD] = timestamp
+            document[TIME_SERIES_META_FIELD] = symbol
+        return documents
 
 
 
 
-    def _get_start_cursor(self, collection: pymongo.database.Collection) -> Cursor | None:
+    def _get_last_close_time(self, market: t_market, symbol: str, interval: t_interval) -> int | None:
+        collection = self._get_kline_collection(market=market, symbol=symbol, interval=interval)
         obj = collection.find_one(sort=[("open_time", pymongo.DESCENDING)])
         
         if isinstance(obj, dict): 
-            next_open_unix = obj["close_time"] + 1  # adding 1 sec / ms / us / ns .. this should make no difference
-            return timestamp_to_cursor(next_open_unix) 
+            return obj["close_time"]
+        return None
+
+
+    def _get_first_open_time(self, market: t_market, symbol: str, interval: t_interval) -> int | None:
+        collection = self._get_kline_collection(market=market, symbol=symbol, interval=interval)
+        obj = collection.find_one(sort=[("open_time", pymongo.ASCENDING)])
         
+        if isinstance(obj, dict): 
+            return obj["open_time"]
         return None
 
 
-    def get_kline_cursor(self, symbol: str, market: t_market, interval: t_interval) -> typing.Tuple[Cursor, bool]:  
+    def read_klines(self, market: t_market, symbol: str, interval: t_interval, start: int | None = None, end: int | None = None, fields: typing.List[str] | None = None) -> OHLCVBatch | np.ndarray:
+        # projected, fetched as raw bson batches and decoded batch by batch straight into numpy columns
         collection = self._get_kline_collection(market=market, symbol=symbol, interval=interval)
+        dtype = get_fields_dtype(fields) if fields is not None else KLINE_DTYPE
+
+        query = {}
+        if start is not None: query["$gte"] = start
+        if end is not None: query["$lte"] = end
         
-        logging.info("try to fetch kline cursor from database... ")
-        cursor, is_initial_binance_cursor = self._get_start_cursor(collection), False
+        projection = {name: 1 for name in dtype.names} | {"_id": 0}
+        cursor = collection.find_raw_batches({"open_time": query} if query else {}, projection, batch_size=READ_BATCH_SIZE).sort("open_time", pymongo.ASCENDING)
+
+        chunks = [decode_raw_batch(batch=batch, dtype=dtype) for batch in cursor]
+        columns = np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+        return OHLCVBatch(columns) if fields is None else columns
 
-        if cursor == None:
-            logging.info("no cursor found in database. try to initialize from Binance first tick of symbol...")
-            cursor, is_initial_binance_cursor = Binance.get_start_cursor(symbol=symbol, market=market), True
-            logging.info(f"first tick on Binance found. cursor: {cursor}")
 
-        assert isinstance(cursor, Cursor)
-        return cursor, is_initial_binance_cursor
+    def read_open_times(self, market: t_market, symbol: str, interval: t_interval) -> np.ndarray:
+        return self.read_klines(market=market, symbol=symbol, interval=interval, fields=["open_time"])["open_time"]
 
 
-    def insert_klines_error_resistant(self, market: t_market, symbol: str, interval: t_interval, klines: typing.List[OHLCV]):
+    def normalize_timestamps(self, market: t_market, symbol: str, interval: t_interval) -> int:
+        # converts the open_time / close_time of klines stored in seconds or microseconds to milliseconds. klines that already
+        # exist in milliseconds (the same kline harvested before and after the unit change) are deleted instead.
+        # the time field of time series collections was always derived in the right unit, updating the other fields of 
+        # time series documents requires MongoDB 7.0+
         collection = self._get_kline_collection(market=market, symbol=symbol, interval=interval)
+        query = {"$or": [{"open_time": {"$gt": TIMESTAMP_UNIT_BOUNDS[1][1]}}, {"open_time": {"$lte": TIMESTAMP_UNIT_BOUNDS[0][1]}}]}
+
+        n_converted = 0
+        while True:
+            documents = list(collection.find(query, {"_id": 1, "open_time": 1, "close_time": 1}, limit=MIGRATION_BATCH_SIZE))
+            if not documents:
+                break
+
+            open_times = unix_ts_to_milliseconds(np.array([d["open_time"] for d in documents], dtype=np.int64)).tolist()
+            close_times = unix_ts_to_milliseconds(np.array([d["close_time"] for d in documents], dtype=np.int64)).tolist()
+            stored = {d["open_time"] for d in collection.find({"open_time": {"$in": open_times}}, {"_id": 0, "open_time": 1})}
+
+            operations = []
+            for document, open_time, close_time in zip(documents, open_times, close_times):
+                if open_time in stored:
+                    operations.append(DeleteOne({"_id": document["_id"]}))
+                else:
+                    operations.append(UpdateOne({"_id": document["_id"]}, {"$set": {"open_time": open_time, "close_time": close_time}}))
+                    stored.add(open_time)
+            collection.bulk_write(operations, ordered=False)
+            n_converted += len(documents)
 
-        klines = [k.model_dump() for k in klines]
+        if n_converted:
+            logging.info(f"{n_converted} klines converted to milliseconds. symbol: {symbol} interval: {interval} market: {market}")
+        return n_converted
 
-        error = False
+
+    @staticmethod
+    def _insert_many(collection: pymongo.collection.Collection, documents: typing.List[typing.Dict]) -> InsertReport:
+        report = InsertReport()
         try:
-            return collection.insert_many(klines, ordered=True)
-        except DuplicateKeyError as e:
-            logging.warning(f"database write attempt raised DuplicateKeyError: {e}")
-            error = True
+            report.inserted = len(collection.insert_many(documents, ordered=False).inserted_ids)  # unacknowledged writes (w=0) are counted as inserted
         except BulkWriteError as e: 
-            logging.warning(f"database write attempt raised BulkWriteError: {e.details}")
-            error = True
-        
-        if error:
-            logging.warning("retry to insert data using the more error tolerant update and upsert logic...")
-            ops = []
-            for k in klines:
-                k.pop("_id", None)
-                ops.append(pymongo.UpdateOne({"open_time": k["open_time"]}, {"$set": k}, upsert=True))
-            return collection.bulk_write(ops, ordered=True)
\ No newline at end of file
+            # documents inserted concurrently by another process since the range query
+            duplicate_errors = [err for err in e.details["writeErrors"] if err["code"] == 11000]
+            if len(duplicate_errors) != len(e.details["writeErrors"]):
+                raise e
+            logging.warning(f"{len(duplicate_errors)} documents of {collection.name} were inserted concurrently")
+            report.inserted = e.details["nInserted"]
+            report.skipped = len(duplicate_errors)
+        return report
+
+
+    def _write_klines(self, market: t_market, symbol: str, interval: t_interval, klines: OHLCVBatch) -> InsertReport:
+        collection = self._get_kline_collection(market=market, symbol=symbol, interval=interval)
+        return self._insert_many(collection=collection, documents=self._to_documents(collection=collection, symbol=symbol, klines=klines))
+
+
+    def _get_last_trade(self, market: t_market, symbol: str, trade_type: t_trade_type) -> typing.Tuple[int, int] | None:
+        collection = self._get_trade_collection(market=market, symbol=symbol, trade_type=trade_type)
+        id_field, time_field = TRADE_ID_FIELDS[trade_type], TRADE_TIME_FIELDS[trade_type]
+        obj = collection.find_one(sort=[(id_field, pymongo.DESCENDING)], projection={"_id": 0, id_field: 1, time_field: 1})
+
+        if isinstance(obj, dict):
+            return obj[id_field], obj[time_field]
+        return None
+
+
+    def _write_trades(self, market: t_market, symbol: str, trade_type: t_trade_type, trades: np.ndarray) -> InsertReport:
+        collection = self._get_trade_collection(market=market, symbol=symbol, trade_type=trade_type)
+        names = trades.dtype.names
+        return self._insert_many(collection=collection, documents=[dict(zip(names, row)) for row in trades.tolist()])
@@ -1,5 +1,64 @@
-import typing, logging
-from pydantic import BaseModel, Field
+import typing, logging, random, threading, tempfile
+import numpy as np
+from datetime import timedelta
+from pydantic import BaseModel, ConfigDict, Field
+from lib.utility import Cursor, get_timestamp_unit, convert_to_milliseconds, unix_ts_to_milliseconds
+from lib.Types import *
+
+
+VALIDATION_SAMPLE_SIZE = 16
+
+# stored in milliseconds, whatever unit the source used
+TIMESTAMP_FIELDS = ["open_time", "close_time"]
+
+# column layout of the binance kline csv files and rest responses
+KLINE_DTYPE = np.dtype([
+    ("open_time", np.int64),
+    ("open", np.float64),
+    ("high", np.float64),
+    ("low", np.float64),
+    ("close", np.float64),
+    ("volume", np.float64),
+    ("close_time", np.int64),
+    ("quote_asset_volume", np.float64),
+    ("number_of_trades", np.int64),
+    ("taker_buy_base_asset_volume", np.float64),
+    ("taker_buy_quote_asset_volume", np.float64),
+    ("ignore", np.int64),
+])
+
+# column layout of the binance trades / aggTrades csv files. futures archives have no is_best_match column (stored as False)
+TRADE_DTYPES: typing.Dict[str, np.dtype] = {
+    "trades": np.dtype([
+        ("id", np.int64),
+        ("price", np.float64),
+        ("qty", np.float64),
+        ("quote_qty", np.float64),
+        ("time", np.int64),
+        ("is_buyer_maker", np.bool_),
+        ("is_best_match", np.bool_),
+    ]),
+    "aggTrades": np.dtype([
+        ("agg_trade_id", np.int64),
+        ("price", np.float64),
+        ("quantity", np.float64),
+        ("first_trade_id", np.int64),
+        ("last_trade_id", np.int64),
+        ("transact_time", np.int64),
+        ("is_buyer_maker", np.bool_),
+        ("is_best_match", np.bool_),
+    ]),
+}
+TRADE_ID_FIELDS: typing.Dict[str, str] = {"trades": "id", "aggTrades": "agg_trade_id"}
+TRADE_TIME_FIELDS: typing.Dict[str, str] = {"trades": "time", "aggTrades": "transact_time"}
+
+
+def get_fields_dtype(fields: typing.List[str]) -> np.dtype:
+    # dtype of a subset of the kline columns, e.g. the result of a projected read
+    unknown = [name for name in fields if name not in KLINE_DTYPE.names]
+    if unknown:
+        raise ValueError(f"unknown kline fields: {', '.join(unknown)}. valid fields are: {', '.join(KLINE_DTYPE.names)}")
+    return np.dtype([(name, KLINE_DTYPE[name]) for name in fields])
 
 
 class OHLCV(BaseModel):
@@ -42,4 +101,198 @@ class OHLCV(BaseModel):
         return [OHLCV.init(r) for r in raw_data]
     
 
+    @staticmethod
+    def validate_sample(raw_data: typing.List[typing.List], columns: np.ndarray, sample_size: int = VALIDATION_SAMPLE_SIZE):
+        # cross check the columnar parser against the pydantic model. all rows in debug mode, a random sample otherwise
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            indices = range(len(raw_data))
+        else:
+            indices = random.sample(range(len(raw_data)), min(sample_size, len(raw_data)))
+
+        for i in indices:
+            expected = OHLCV.init(raw_data[i]).model_dump(exclude={"ignore"})
+            actual = dict(zip(KLINE_DTYPE.names, columns[i].tolist()))
+            mismatch = [key for key, value in expected.items() if actual[key] != value]
+            if mismatch:
+                raise ValueError(f"columnar kline parser mismatch in fields {', '.join(mismatch)}. row: {raw_data[i]}")
+
+
+
+
+class OHLCVBatch:
+    # array backed batch of klines. all slices share the memory of the underlying structured array
+    __slots__ = ("columns",)
+
+    def __init__(self, columns: np.ndarray):
+        assert columns.dtype == KLINE_DTYPE
+        self.columns = columns
+    
+
+    @staticmethod
+    def empty() -> "OHLCVBatch":
+        return OHLCVBatch(np.empty(0, dtype=KLINE_DTYPE))
+
+
+    @staticmethod
+    def from_raw(raw_data: typing.List[typing.List]) -> "OHLCVBatch":
+        # fast path: converts all rows column by column instead of building one model per row
+        logging.info(f"Parsing {len(raw_data)} klines into columns...")
+        columns = np.empty(len(raw_data), dtype=KLINE_DTYPE)
+        for name, raw_column in zip(KLINE_DTYPE.names, zip(*raw_data)):
+            columns[name] = np.array(raw_column, dtype=KLINE_DTYPE[name])
+
+        OHLCV.validate_sample(raw_data=raw_data, columns=columns)
+        return OHLCVBatch(columns).normalize_timestamps()
+    
+
+    def normalize_timestamps(self) -> "OHLCVBatch":
+        # converts the timestamps into milliseconds in place (binance spot archives switched to microseconds in 2025).
+        # the unit is detected once per batch, batches mixing units (never seen in a single file) are converted value by value
+        if len(self) == 0:
+            return self
+        
+        unit = get_timestamp_unit(int(self.columns["open_time"][0]))
+        if unit != get_timestamp_unit(int(self.columns["open_time"][-1])):
+            logging.warning(f"klines with mixed timestamp units found. open_times: {self.columns['open_time'][0]} - {self.columns['open_time'][-1]}")
+            for name in TIMESTAMP_FIELDS:
+                self.columns[name] = unix_ts_to_milliseconds(self.columns[name])
+        elif unit != "ms":
+            for name in TIMESTAMP_FIELDS:
+                self.columns[name] = convert_to_milliseconds(self.columns[name], unit)
+        return self
+    
+
+    @staticmethod
+    def from_documents(documents: typing.List[typing.Dict]) -> "OHLCVBatch":
+        return OHLCVBatch(np.array([tuple(d.get(name, 0) for name in KLINE_DTYPE.names) for d in documents], dtype=KLINE_DTYPE))
+    
+
+    @staticmethod
+    def concatenate(batches: typing.List["OHLCVBatch"]) -> "OHLCVBatch":
+        if not batches:
+            return OHLCVBatch.empty()
+        return OHLCVBatch(np.concatenate([b.columns for b in batches]))
+
+
+    def to_dataframe(self):
+        # requires pandas (not installed by requirements.txt)
+        import pandas as pd
+        return pd.DataFrame(self.columns)
+
+
+    def to_documents(self) -> typing.List[typing.Dict]:
+        names = KLINE_DTYPE.names
+        return [dict(zip(names, row)) for row in self.columns.tolist()]
+
+
+    def __len__(self):
+        return len(self.columns)
+    
+
+    def __getitem__(self, index) -> "OHLCVBatch | OHLCV":
+        if isinstance(index, (int, np.integer)):
+            return OHLCV.init(self.columns[index].tolist())
+        return OHLCVBatch(self.columns[index])
+    
+
+    def __iter__(self) -> typing.Iterator[OHLCV]:
+        for row in self.columns.tolist():
+            yield OHLCV.init(row)
+    
+
+    def __getattr__(self, name: str) -> np.ndarray:
+        # column access, e.g. batch.open_time
+        if name in KLINE_DTYPE.names:
+            return self.columns[name]
+        raise AttributeError(f"{type(self).__name__} has no attribute {name}")
+    
+
+    def __repr__(self):
+        return f"OHLCVBatch(len={len(self)})"
+
+
+
+class InsertReport(BaseModel):
+    inserted: int = 0
+    skipped: int = 0        # already stored with identical values
+    conflicting: int = 0    # already stored with different values. the stored values are kept
+
+
+    def __add__(self, other: "InsertReport") -> "InsertReport":
+        return InsertReport(inserted=self.inserted + other.inserted, 
+                            skipped=self.skipped + other.skipped, 
+                            conflicting=self.conflicting + other.conflicting)
+
+
+
+class HarvestProgress:
+    # progress of all symbols harvested concurrently. shared by the symbol worker threads
+    def __init__(self, symbols: typing.List[str]):
+        self.symbols = symbols
+        self.total_archives: typing.Dict[str, int] = {}
+        self.done_archives: typing.Dict[str, int] = {symbol: 0 for symbol in symbols}
+        self.finished: typing.List[str] = []
+        self.failed: typing.Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+
+    def start(self, symbol: str, total_archives: int):
+        with self._lock:
+            self.total_archives[symbol] = total_archives
+
+
+    def advance(self, symbol: str):
+        with self._lock:
+            self.done_archives[symbol] += 1
+            logging.info(f"progress: {symbol} {self.done_archives[symbol]}/{self.total_archives.get(symbol, '?')} archives | all symbols: {sum(self.done_archives.values())}/{sum(self.total_archives.values())} archives, {len(self.finished)}/{len(self.symbols)} symbols finished, {len(self.failed)} failed")
+
+
+    def finish(self, symbol: str, error: BaseException | None = None):
+        with self._lock:
+            if error is None:
+                self.finished.append(symbol)
+            else:
+                self.failed[symbol] = repr(error)
+
+
+
+class ArchiveFile(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    period: t_period
+    cursor: Cursor  # first day covered by the archive
+
+
+    def get_date(self) -> str:
+        if self.period == "monthly":
+            return f"{self.cursor.year}-{self.cursor.get_month()}"
+        return f"{self.cursor.year}-{self.cursor.get_month()}-{self.cursor.get_day()}"
+    
+
+    def get_end(self) -> Cursor:
+        # first day after the archive
+        if self.period == "monthly":
+            return (self.cursor.replace(day=28) + timedelta(days=4)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        return self.cursor.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    
+
+    def get_days(self) -> typing.List["ArchiveFile"]:
+        if self.period == "daily":
+            return [self]
+        
+        days, day = [], self.cursor.replace(day=1)
+        while day.month == self.cursor.month:
+            days.append(ArchiveFile(period="daily", cursor=day))
+            day += timedelta(days=1)
+        return days
+
+
+
+class ArchiveDownload(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    archive: ArchiveFile
+    url: str
+    source: str | tempfile.SpooledTemporaryFile | None  # path in the zip cache or the downloaded file. None if the archive does not exist (404)
+    checksum: str | None = None     # sha256 of the zip
 
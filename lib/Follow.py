@@ -0,0 +1,164 @@
+import heapq, itertools, logging, threading, time, typing
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, UTC, timedelta
+from lib.Storage import KlineStorage
+from lib.KlineWriter import KlineWriter
+from lib.DataStructures import ArchiveFile
+from lib.Gaps import fill_gaps
+from lib.utility import *
+from lib.Types import *
+
+
+# data.binance.vision publishes the daily archives some time after the UTC rollover
+ARCHIVE_PUBLICATION_DELAY = 30 * 60
+# a daily archive that is not published yet is checked again after ARCHIVE_RETRY_INTERVAL seconds
+ARCHIVE_RETRY_INTERVAL = 30 * 60
+# a failed harvest of a symbol is retried after ERROR_RETRY_INTERVAL seconds
+ERROR_RETRY_INTERVAL = 5 * 60
+# rest top-ups run at most once per MIN_TOP_UP_PERIOD seconds (1s klines) and TOP_UP_DELAY seconds after the interval closed
+MIN_TOP_UP_PERIOD = 60
+TOP_UP_DELAY = 2
+# the top-up only covers the recent days the archives are not published for yet. older gaps are left to the archives
+TOP_UP_MAX_LOOKBACK = 2 * 86400
+# upper bound of a single idle wait of the scheduler
+MAX_WAIT = 60
+
+
+def top_up_klines(symbol: str, market: t_market, interval: t_interval, dao: KlineStorage, writer: KlineWriter, cursor: int | None = None) -> int | None:
+    # fetches the closed klines after the newest stored kline (or `cursor`, the klines topped up but possibly not written yet)
+    # through the rest api, at most TOP_UP_MAX_LOOKBACK seconds back. returns the open_time of the next kline to top up.
+    # a symbol without stored klines is not topped up, its history is harvested from the archives
+    step = interval_to_milliseconds(interval)
+    # the klines of the harvest that just ran may still be queued in the writer
+    writer.flush()
+    close_time = dao._get_last_close_time(market=market, symbol=symbol, interval=interval)
+    if close_time is None and cursor is None:
+        logging.warning(f"no klines stored yet, skipping the rest top-up. symbol: {symbol} interval: {interval} market: {market}")
+        return None
+
+    stored_cursor = int(unix_ts_to_milliseconds(close_time)) + 1 if close_time is not None else cursor
+    cursor = stored_cursor if cursor is None else max(cursor, stored_cursor)
+
+    # the kline of the current interval is still open
+    now = int(time.time() * 1000)
+    last_closed = (now // step - 1) * step
+    cursor = max(cursor, (now - TOP_UP_MAX_LOOKBACK * 1000) // step * step)
+    if cursor > last_closed:
+        return cursor
+
+    n_filled = fill_gaps(symbol=symbol, market=market, interval=interval, gaps=[(cursor, last_closed)], writer=writer)
+    logging.info(f"{n_filled} klines topped up through the rest api. symbol: {symbol} interval: {interval} market: {market}")
+    return last_closed + step if n_filled else cursor
+
+
+class FollowScheduler:
+    # --follow: harvests the symbols continuously instead of once. every symbol's next daily archive is harvested
+    # after it is published and (with `top_up`) the current day is topped up through the rest api after every closed interval.
+    # the symbols are spread over `spread` seconds after the publication delay (and over the top-up period) so that the work
+    # does not pile up at the UTC rollover. every symbol has at most one pending run, runs of the same symbol never overlap
+    def __init__(self,
+                 symbols: typing.List[str],
+                 interval: t_interval | None,
+                 harvest: typing.Callable[[str, Cursor | None], typing.List[ArchiveFile]],
+                 top_up: typing.Callable[[str, int | None], int] | None = None,
+                 workers: int = 1,
+                 spread: float = 3600):
+        self.symbols = symbols
+        self.harvest = harvest
+        self.top_up = top_up
+        self.workers = workers
+        # trades / aggTrades have no interval and no top-up
+        self.top_up_period = max(INTERVAL_SECONDS[interval], MIN_TOP_UP_PERIOD) if interval is not None else MIN_TOP_UP_PERIOD
+
+        # deterministic offset per symbol, the same symbol runs at the same time every day
+        self._archive_offsets = {symbol: spread * i / len(symbols) for i, symbol in enumerate(symbols)}
+        self._top_up_offsets = {symbol: min(spread, self.top_up_period / 2) * i / len(symbols) for i, symbol in enumerate(symbols)}
+
+        self._next_archive: typing.Dict[str, float] = {}
+        self._next_top_up: typing.Dict[str, float] = {}
+        self._top_up_cursors: typing.Dict[str, int | None] = {symbol: None for symbol in symbols}
+        # first day whose archive was not harvested yet. the top-up moves the storage cursor past the UTC rollover,
+        # the archives are planned from this cursor instead
+        self._archive_cursors: typing.Dict[str, Cursor | None] = {symbol: None for symbol in symbols}
+        # symbols whose last archive harvest failed are not topped up until it succeeds
+        self._failed_harvests: typing.Set[str] = set()
+
+        self._queue: typing.List[typing.Tuple[float, int, str]] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+
+    def _schedule(self, symbol: str):
+        due = min(self._next_archive[symbol], self._next_top_up.get(symbol, float("inf")))
+        with self._condition:
+            heapq.heappush(self._queue, (due, next(self._sequence), symbol))
+            self._condition.notify()
+        logging.debug(f"next run of {symbol}: {datetime.fromtimestamp(due, tz=UTC)}")
+
+
+    def _get_next_archive_time(self, symbol: str, now: float, missing: typing.List[ArchiveFile]) -> float:
+        yesterday = datetime.fromtimestamp(now, tz=UTC).date() - timedelta(days=1)
+        if missing and missing[-1].cursor.date() >= yesterday:
+            logging.info(f"daily archive {missing[-1].get_date()} of {symbol} is not published yet. checking again in {ARCHIVE_RETRY_INTERVAL}s")
+            return now + ARCHIVE_RETRY_INTERVAL
+
+        next_rollover = (now // 86400 + 1) * 86400
+        return next_rollover + ARCHIVE_PUBLICATION_DELAY + self._archive_offsets[symbol]
+
+
+    @staticmethod
+    def _get_archive_cursor(now: float, missing: typing.List[ArchiveFile]) -> Cursor:
+        # the oldest recent archive that is not published yet, else the current day
+        yesterday = datetime.fromtimestamp(now, tz=UTC).date() - timedelta(days=1)
+        pending = [archive.cursor for archive in missing if archive.cursor.date() >= yesterday]
+        return min(pending, default=Cursor.fromtimestamp(now // 86400 * 86400, tz=UTC))
+
+
+    def _run_symbol(self, symbol: str):
+        now = time.time()
+        if now >= self._next_archive[symbol]:
+            try:
+                missing = self.harvest(symbol, self._archive_cursors[symbol])
+            except Exception as e:
+                logging.exception(f"harvesting {symbol} failed: {e}. retrying in {ERROR_RETRY_INTERVAL}s")
+                self._next_archive[symbol] = now + ERROR_RETRY_INTERVAL
+                self._failed_harvests.add(symbol)
+            else:
+                self._failed_harvests.discard(symbol)
+                self._archive_cursors[symbol] = self._get_archive_cursor(now=now, missing=missing)
+                self._next_archive[symbol] = self._get_next_archive_time(symbol=symbol, now=time.time(), missing=missing)
+
+        if self.top_up is not None and now >= self._next_top_up.get(symbol, 0):
+            if symbol in self._failed_harvests:
+                logging.warning(f"skipping the rest top-up of {symbol} until its archive harvest succeeds")
+            else:
+                try:
+                    self._top_up_cursors[symbol] = self.top_up(symbol, self._top_up_cursors[symbol])
+                except Exception as e:
+                    logging.exception(f"topping up {symbol} failed: {e}")
+            self._next_top_up[symbol] = (time.time() // self.top_up_period + 1) * self.top_up_period + TOP_UP_DELAY + self._top_up_offsets[symbol]
+
+        self._schedule(symbol)
+
+
+    def run(self):
+        # runs until interrupted (KeyboardInterrupt). running harvests are finished before returning
+        logging.info(f"following {len(self.symbols)} symbols. rest top-up: {self.top_up is not None} workers: {self.workers}")
+        now = time.time()
+        for symbol in self.symbols:
+            self._next_archive[symbol] = now
+            self._schedule(symbol)
+
+        pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="follow")
+        try:
+            while True:
+                with self._condition:
+                    while not self._queue or self._queue[0][0] > time.time():
+                        timeout = self._queue[0][0] - time.time() if self._queue else MAX_WAIT
+                        self._condition.wait(timeout=min(timeout, MAX_WAIT))
+                    _, _, symbol = heapq.heappop(self._queue)
+                pool.submit(self._run_symbol, symbol)
+        except KeyboardInterrupt:
+            logging.warning("follow mode interrupted. waiting for the running harvests...")
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,64 @@
+import logging, typing
+import numpy as np
+from lib.Storage import KlineStorage
+from lib.KlineWriter import KlineWriter
+from lib.DataStructures import OHLCVBatch
+from lib.utility import *
+from lib.Types import *
+
+
+def find_gaps(open_times: np.ndarray, interval: t_interval) -> typing.List[typing.Tuple[int, int]]:
+    # missing open_time ranges (inclusive, milliseconds) between the first and the last stored kline
+    step = interval_to_milliseconds(interval)
+    open_times = np.sort(unix_ts_to_milliseconds(open_times))
+    if len(open_times) < 2:
+        return []
+    
+    diffs = np.diff(open_times)
+
+    misaligned = np.count_nonzero((diffs < step) | (diffs % step != 0))
+    if misaligned:
+        logging.warning(f"{misaligned} open_times are duplicated or not aligned to the interval {interval}")
+
+    gap_indices = np.nonzero(diffs > step)[0]
+    return [(int(open_times[i] + step), int(open_times[i + 1] - step)) for i in gap_indices]
+
+
+def fill_gaps(symbol: str, market: t_market, interval: t_interval, gaps: typing.List[typing.Tuple[int, int]], writer: KlineWriter) -> int:
+    # fetches the missing klines through the rest api in batches of Binance.KLINES_LIMIT klines
+    step = interval_to_milliseconds(interval)
+    n_filled = 0
+
+    for gap_start, gap_end in gaps:
+        logging.info(f"filling gap {timestamp_to_datetime(gap_start)} - {timestamp_to_datetime(gap_end)} ({(gap_end - gap_start) // step + 1} klines) symbol: {symbol} interval: {interval} market: {market}")
+
+        cursor = gap_start
+        while cursor <= gap_end:
+            raw_klines = Binance.get_klines(symbol=symbol, market=market, interval=interval, start_time=cursor, end_time=gap_end)
+            if not raw_klines:
+                logging.warning(f"no klines available on Binance from {timestamp_to_datetime(cursor)} to {timestamp_to_datetime(gap_end)} symbol: {symbol} interval: {interval} market: {market}")
+                break
+
+            klines = OHLCVBatch.from_raw(raw_data=raw_klines)
+            writer.put(market=market, symbol=symbol, interval=interval, klines=klines)
+            n_filled += len(klines)
+            cursor = int(klines.open_time[-1]) + step
+    
+    return n_filled
+
+
+def find_and_fill_gaps(symbol: str, market: t_market, interval: t_interval, dao: KlineStorage, writer: KlineWriter, fill: bool = True) -> typing.List[typing.Tuple[int, int]]:
+    logging.info(f"scanning for gaps... symbol: {symbol} interval: {interval} market: {market}")
+    open_times = dao.read_open_times(market=market, symbol=symbol, interval=interval)
+    gaps = find_gaps(open_times=open_times, interval=interval)
+
+    n_missing = sum((gap_end - gap_start) // interval_to_milliseconds(interval) + 1 for gap_start, gap_end in gaps)
+    logging.info(f"{len(gaps)} gaps with {n_missing} missing klines found in {len(open_times)} stored klines. symbol: {symbol} interval: {interval} market: {market}")
+    for gap_start, gap_end in gaps:
+        logging.debug(f"gap: {timestamp_to_datetime(gap_start)} - {timestamp_to_datetime(gap_end)}")
+
+    if fill and gaps:
+        n_filled = fill_gaps(symbol=symbol, market=market, interval=interval, gaps=gaps, writer=writer)
+        logging.info(f"{n_filled} klines fetched from the rest api to fill the gaps. symbol: {symbol} interval: {interval} market: {market}")
+    
+    return gaps
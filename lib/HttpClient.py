@@ -0,0 +1,123 @@
+import logging, random, time, typing, hashlib
+import requests
+from requests.adapters import HTTPAdapter
+from lib import RateLimiter, Metrics
+from lib.utility import SharedInstance
+
+
+RETRY_STATUS_CODES = {418, 429, 500, 502, 503, 504}
+RETRY_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+class HttpClient:
+    # shared http client for all Binance requests. keeps a bounded keep-alive connection pool per host,
+    # retries dropped connections, 418 / 429 / 5xx responses with exponential backoff and jitter (or Retry-After)
+    # and keeps the rate limiters in sync with the weight reported by Binance (X-MBX-USED-WEIGHT-1M).
+    # `base_url_overrides` redirects hosts, e.g. {"https://data.binance.vision": "http://127.0.0.1:8080"} for a local stand-in server
+    def __init__(self, 
+                 pool_size: int = 32, 
+                 max_retries: int = 5, 
+                 backoff_base: float = 0.5, 
+                 backoff_max: float = 60.0, 
+                 connect_timeout: float = 10.0, 
+                 read_timeout: float = 60.0,
+                 base_url_overrides: typing.Dict[str, str] | None = None):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = (connect_timeout, read_timeout)
+        self.base_url_overrides = base_url_overrides or {}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size, pool_block=True, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+
+    def _resolve(self, url: str) -> str:
+        for base_url, override in self.base_url_overrides.items():
+            if url.startswith(base_url):
+                return override + url[len(base_url):]
+        return url
+
+
+    def _get_backoff(self, attempt: int, res: requests.Response | None = None) -> float:
+        retry_after = res.headers.get("Retry-After") if res is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))  # full jitter
+
+
+    @staticmethod
+    def _sync_used_weight(url: str, res: requests.Response):
+        used_weight = res.headers.get("X-MBX-USED-WEIGHT-1M") or res.headers.get("X-MBX-USED-WEIGHT")
+        if used_weight is not None and used_weight.isdigit():
+            RateLimiter.get_rate_limiter(url).sync_used_weight(int(used_weight))
+
+
+    def get(self, url: str, weight: float = 1, stream: bool = False, timeout: float | None = None, max_retries: int | None = None, symbol: str | None = None) -> requests.Response:
+        # the rate limiter is keyed by the original url, the request goes to the (possibly overridden) resolved url.
+        # `timeout` and `max_retries` override the client settings for requests with a cheap fallback.
+        # the metrics of requests made for a `symbol` are also counted per symbol
+        resolved_url = self._resolve(url)
+        timeout = self.timeout if timeout is None else (min(self.timeout[0], timeout), timeout)
+        max_retries = self.max_retries if max_retries is None else max_retries
+
+        metrics = Metrics.get_metrics()
+        for attempt in range(max_retries + 1):
+            RateLimiter.acquire(url, weight=weight)
+            metrics.increment("http_requests", symbol=symbol)
+            metrics.increment("http_retries", 1 if attempt else 0, symbol=symbol)
+            try:
+                with metrics.timer("http_request", symbol=symbol):
+                    res = self.session.get(resolved_url, stream=stream, timeout=timeout)
+            except RETRY_EXCEPTIONS as e:
+                if attempt == max_retries:
+                    raise e
+                delay = self._get_backoff(attempt)
+                logging.warning(f"request failed: {e}. retry {attempt + 1}/{max_retries} in {delay:.1f}s. url: {url}")
+                time.sleep(delay)
+                continue
+
+            self._sync_used_weight(url=url, res=res)
+            if res.status_code in RETRY_STATUS_CODES and attempt < max_retries:
+                delay = self._get_backoff(attempt, res=res)
+                logging.warning(f"request failed with status {res.status_code}. retry {attempt + 1}/{max_retries} in {delay:.1f}s. url: {url}")
+                res.close()
+                time.sleep(delay)
+                continue
+
+            if res.status_code == 404:
+                metrics.increment("http_not_found", symbol=symbol)
+            if res.status_code >= 400:
+                # release the pooled connection of a streamed response. the pool blocks once all connections are leaked
+                res.close()
+            res.raise_for_status()
+            return res
+
+
+    def download(self, url: str, fp: typing.BinaryIO, chunk_size: int = 65536, symbol: str | None = None) -> str:
+        # streams the response body into fp and returns its sha256. a connection dropped while reading the body restarts the download
+        start = fp.tell()
+        for attempt in range(self.max_retries + 1):
+            sha256 = hashlib.sha256()
+            fp.seek(start)
+            fp.truncate()
+            try:
+                with self.get(url, stream=True, symbol=symbol) as res:
+                    for chunk in res.iter_content(chunk_size=chunk_size): 
+                        fp.write(chunk)
+                        sha256.update(chunk)
+                return sha256.hexdigest()
+            except RETRY_EXCEPTIONS as e:
+                if attempt == self.max_retries:
+                    raise e
+                delay = self._get_backoff(attempt)
+                logging.warning(f"download interrupted: {e}. retry {attempt + 1}/{self.max_retries} in {delay:.1f}s. url: {url}")
+                time.sleep(delay)
+
+
+
+_http_client = SharedInstance(HttpClient)
+configure = _http_client.configure
+get_http_client = _http_client.get
@@ -0,0 +1,165 @@
+import logging, queue, threading, typing, collections
+from lib.Storage import KlineStorage
+from lib.DataStructures import OHLCVBatch, InsertReport
+from lib.Types import *
+from lib import Metrics
+
+
+t_writer_key = typing.Tuple[t_market, str, t_interval]
+
+# blocking calls check every WRITER_POLL_INTERVAL seconds whether the writer thread is still running
+WRITER_POLL_INTERVAL = 1.0
+
+
+class KlineWriter:
+    # write-behind stage. batches are queued by the harvesting threads and written by a single background thread.
+    # consecutive batches of the same collection are merged until `batch_size` klines are buffered.
+    # the bounded queue blocks the producers if the database can not keep up (backpressure)
+    def __init__(self, dao: KlineStorage, batch_size: int, queue_size: int, flush_interval: float = 5.0):
+        self.dao = dao
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.reports: typing.Dict[t_writer_key, InsertReport] = collections.defaultdict(InsertReport)
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._buffers: typing.Dict[t_writer_key, typing.List[OHLCVBatch]] = {}
+        self._buffer_sizes: typing.Dict[t_writer_key, int] = collections.defaultdict(int)
+        self._callbacks: typing.Dict[t_writer_key, typing.List[typing.Callable[[], None]]] = collections.defaultdict(list)
+        self._error: BaseException | None = None
+
+        self._thread = threading.Thread(target=self._run, name="kline-writer", daemon=True)
+        self._thread.start()
+
+
+    def put(self, market: t_market, symbol: str, interval: t_interval, klines: OHLCVBatch):
+        self._raise_on_error()
+        with Metrics.get_metrics().timer("queue_wait", symbol=symbol):
+            self._put(("klines", (market, symbol, interval), klines))
+
+
+    def on_written(self, market: t_market, symbol: str, interval: t_interval, callback: typing.Callable[[], None]):
+        # calls `callback` in the writer thread once all klines of the collection queued so far are written
+        self._raise_on_error()
+        self._put(("callback", (market, symbol, interval), callback))
+
+
+    def flush(self):
+        # blocks until all klines queued so far are written
+        self._wait("flush")
+        self._raise_on_error()
+
+
+    def close(self):
+        if not self._thread.is_alive():
+            self._raise_on_error()
+            return
+        
+        self._wait("close")
+        self._thread.join()
+        self._raise_on_error()
+
+
+    def _raise_on_error(self):
+        if self._error is not None:
+            raise RuntimeError(f"kline writer failed: {self._error}") from self._error
+
+
+    def _check_alive(self):
+        # a dead writer thread never drains the queue. raise instead of blocking forever
+        if not self._thread.is_alive():
+            self._raise_on_error()
+            raise RuntimeError("kline writer is not running")
+
+
+    def _put(self, item: typing.Tuple):
+        while True:
+            self._check_alive()
+            try:
+                self._queue.put(item, timeout=WRITER_POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+
+    def _wait(self, kind: str):
+        done = threading.Event()
+        self._put((kind, None, done))
+        while not done.wait(timeout=WRITER_POLL_INTERVAL):
+            self._check_alive()
+
+
+    def _run(self):
+        try:
+            self._loop()
+        except BaseException as e:
+            logging.exception(f"kline writer stopped: {e}")
+            self._error = self._error or e
+
+
+    def _loop(self):
+        while True:
+            try:
+                kind, key, payload = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                # idle. write whatever is buffered so that slow producers do not delay their klines forever
+                self._flush_all()
+                continue
+
+            if kind == "klines":
+                if self._error is None:
+                    self._buffers.setdefault(key, []).append(payload)
+                    self._buffer_sizes[key] += len(payload)
+                    if self._buffer_sizes[key] >= self.batch_size:
+                        self._flush(key)
+                continue
+
+            if kind == "callback":
+                if key in self._buffers:
+                    self._callbacks[key].append(payload)
+                elif self._error is None:
+                    self._run_callbacks([payload])
+                continue
+
+            self._flush_all()
+            payload.set()
+            if kind == "close":
+                return
+
+
+    def _run_callbacks(self, callbacks: typing.List[typing.Callable[[], None]]):
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f"kline writer callback failed: {e}")
+
+
+    def _flush_all(self):
+        for key in list(self._buffers.keys()):
+            self._flush(key)
+
+
+    def _flush(self, key: t_writer_key):
+        batches = self._buffers.pop(key, [])
+        self._buffer_sizes.pop(key, None)
+        if self._error is not None or not batches:
+            return
+
+        market, symbol, interval = key
+        metrics = Metrics.get_metrics()
+        try:
+            with metrics.timer("insert", symbol=symbol, hot_path=True):
+                report = self.dao.insert_klines_error_resistant(market=market, symbol=symbol, interval=interval, klines=OHLCVBatch.concatenate(batches))
+        except BaseException as e:
+            # keep draining the queue so that the producers never block forever. the error is raised on their next call
+            logging.error(f"kline writer failed writing {symbol} {interval} ({market}): {e}")
+            self._error = e
+            return
+        
+        self.reports[key] += report
+        metrics.increment("klines_inserted", report.inserted, symbol=symbol)
+        metrics.increment("klines_skipped", report.skipped, symbol=symbol)
+        metrics.increment("klines_conflicting", report.conflicting, symbol=symbol)
+        self._run_callbacks(self._callbacks.pop(key, []))
+        logging.info(f"{report.inserted} klines written in database.. symbol: {symbol} interval: {interval} skipped: {report.skipped} conflicting: {report.conflicting}")
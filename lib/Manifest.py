@@ -0,0 +1,100 @@
+import logging, sqlite3, threading, typing
+from datetime import datetime, UTC, timedelta
+from lib.DataStructures import ArchiveFile
+from lib.utility import *
+from lib.Types import *
+
+
+# a 404 of a recent archive may just mean that it is not published yet
+MISSING_FINAL_AFTER = timedelta(days=3)
+
+
+class HarvestManifest:
+    # persistent state of every archive file per market, symbol and interval (sqlite in BASE_DIR).
+    # ingested files and files that are known to be missing are skipped by the download planner.
+    # a `read_only` manifest (--dry-run) opens an existing file without creating or migrating anything
+    def __init__(self, path: str, read_only: bool = False):
+        logging.info(f"opening harvest manifest {path}...")
+        self.path = path
+        self._lock = threading.Lock()
+
+        if read_only:
+            self._connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False, timeout=60)
+            return
+
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")  # several harvester processes may share the manifest
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS archives (
+                    market TEXT NOT NULL,
+                    symbol TEXT NOT NULL,
+                    interval TEXT NOT NULL,
+                    period TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    rows INTEGER NOT NULL DEFAULT 0,
+                    checksum TEXT,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (market, symbol, interval, period, date)
+                )
+            """)
+
+
+    def get_statuses(self, market: t_market, symbol: str, interval: t_interval) -> typing.Dict[typing.Tuple[str, str], t_manifest_status]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT period, date, status FROM archives WHERE market = ? AND symbol = ? AND interval = ?", 
+                (market, symbol, interval)
+            ).fetchall()
+        return {(period, date): status for period, date, status in rows}
+    
+
+    def get_archive_cursor(self, market: t_market, symbol: str, interval: t_interval) -> Cursor | None:
+        # first day after the newest ingested archive. None if no archive was ingested yet
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT period, MAX(date) FROM archives WHERE market = ? AND symbol = ? AND interval = ? AND status = 'ingested' GROUP BY period", 
+                (market, symbol, interval)
+            ).fetchall()
+        ends = [ArchiveFile(period=period, cursor=Cursor.strptime(date, "%Y-%m" if period == "monthly" else "%Y-%m-%d").replace(tzinfo=UTC)).get_end() 
+                for period, date in rows]
+        return max(ends, default=None)
+    
+
+    def record(self, market: t_market, symbol: str, interval: t_interval, archive: ArchiveFile, url: str, status: t_manifest_status, rows: int = 0, checksum: str | None = None):
+        now = datetime.now(tz=UTC).isoformat()
+        with self._lock, self._connection:
+            self._connection.execute("""
+                INSERT INTO archives (market, symbol, interval, period, date, url, status, rows, checksum, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (market, symbol, interval, period, date) DO UPDATE SET 
+                    url = excluded.url, status = excluded.status, rows = excluded.rows, checksum = excluded.checksum, updated_at = excluded.updated_at
+            """, (market, symbol, interval, archive.period, archive.get_date(), url, status, rows, checksum, now, now))
+    
+
+    def filter_plan(self, market: t_market, symbol: str, interval: t_interval, plan: typing.List[ArchiveFile], now: datetime) -> typing.List[ArchiveFile]:
+        # drops ingested and known-missing archives. failed archives are retried.
+        # a known-missing monthly archive is replaced by the daily archives of the month
+        statuses = self.get_statuses(market=market, symbol=symbol, interval=interval)
+
+        filtered = []
+        for archive in plan:
+            status = statuses.get((archive.period, archive.get_date()))
+            is_final = now - archive.get_end() > MISSING_FINAL_AFTER
+
+            if status == "ingested":
+                continue
+            elif status == "missing" and archive.period == "monthly" and (is_final or any(("daily", day.get_date()) in statuses for day in archive.get_days())):
+                # the daily fallback of the month has already started
+                filtered += self.filter_plan(market=market, symbol=symbol, interval=interval, plan=archive.get_days(), now=now)
+                continue
+            elif status == "missing" and is_final:
+                continue
+            filtered.append(archive)
+        
+        if len(filtered) != len(plan):
+            logging.info(f"manifest: {len(plan)} planned archives reduced to {len(filtered)} archives. symbol: {symbol} interval: {interval} market: {market}")
+        return filtered
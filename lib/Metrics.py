@@ -0,0 +1,206 @@
+import contextlib, cProfile, json, logging, os, pstats, threading, time, typing
+from lib.utility import SharedInstance
+
+
+METRICS_PREFIX = "binance_harvester"
+
+# counters (prometheus *_total) and timers (prometheus summaries *_seconds_sum / *_seconds_count) recorded by the harvester
+COUNTERS = {
+    "http_requests": "http requests sent, including retries",
+    "http_retries": "http requests retried after a connection error, 418, 429 or 5xx",
+    "http_not_found": "http requests answered with 404",
+    "download_bytes": "bytes of downloaded or cached archives",
+    "archives_downloaded": "archives downloaded or taken from the zip cache",
+    "archives_missing": "archives not published (404)",
+    "rows_parsed": "kline rows parsed from csv",
+    "klines_inserted": "klines written to the storage",
+    "klines_skipped": "klines already stored with identical values",
+    "klines_conflicting": "klines already stored with different values",
+    "trades_parsed": "trades / aggTrades rows decoded from csv",
+    "trades_inserted": "trades / aggTrades written to the storage",
+    "trades_skipped": "trades / aggTrades skipped because their id was already stored",
+}
+TIMERS = {
+    "http_request": "latency of http requests until the response headers arrived",
+    "download": "archive downloads including retries and checksum validation",
+    "unzip_csv": "decompression and csv reading",
+    "parse": "conversion of csv rows into kline columns",
+    "queue_wait": "time blocked on the full writer queue (backpressure of the storage)",
+    "insert": "storage writes including the duplicate detection",
+}
+
+
+class Metrics:
+    # counters and timers per stage, aggregated per symbol and per run. `symbol=None` only counts for the run.
+    # with `profile` every hot path timer additionally records a cProfile profile of its thread
+    def __init__(self, profile: bool = False):
+        self.started_at = time.time()
+        self.profile = profile
+
+        self._counters: typing.Dict[typing.Tuple[str, str | None], float] = {}
+        self._timers: typing.Dict[typing.Tuple[str, str | None], typing.List[float]] = {}  # count, sum, max
+        self._lock = threading.Lock()
+
+        self._profiles: typing.List[cProfile.Profile] = []
+        self._local = threading.local()
+
+
+    def increment(self, name: str, value: float = 1, symbol: str | None = None):
+        with self._lock:
+            for key in ((name, None), (name, symbol)) if symbol is not None else ((name, None),):
+                self._counters[key] = self._counters.get(key, 0) + value
+
+
+    def observe(self, name: str, seconds: float, symbol: str | None = None):
+        with self._lock:
+            for key in ((name, None), (name, symbol)) if symbol is not None else ((name, None),):
+                timer = self._timers.setdefault(key, [0, 0.0, 0.0])
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+
+    @contextlib.contextmanager
+    def timer(self, name: str, symbol: str | None = None, hot_path: bool = False):
+        profile = self._get_profile() if hot_path and self.profile else None
+        if profile is not None:
+            try:
+                profile.enable()
+            except ValueError:
+                # python 3.12+ allows only one active profiler per process. the section is timed but not profiled
+                profile = None
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name=name, seconds=time.perf_counter() - start, symbol=symbol)
+            if profile is not None:
+                profile.disable()
+
+
+    def _get_profile(self) -> cProfile.Profile:
+        # one profile per thread. cProfile only records the thread that enabled it
+        profile = getattr(self._local, "profile", None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+        return profile
+
+
+    def dump_profile(self, path: str):
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            logging.warning("no hot path profile recorded")
+            return
+
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+        logging.info(f"hot path profile written to {path}. view it with `python -m pstats {path}`")
+
+
+    def _summarize(self, symbol: str | None) -> typing.Dict[str, typing.Any]:
+        counters = {name: value for (name, key_symbol), value in self._counters.items() if key_symbol == symbol}
+        timers = {}
+        for (name, key_symbol), (count, total, maximum) in self._timers.items():
+            if key_symbol == symbol:
+                timers[name] = {"count": count, "seconds": round(total, 6), "mean_ms": round(total / count * 1000, 3), "max_ms": round(maximum * 1000, 3)}
+
+        rates = {}
+        if counters.get("rows_parsed") and timers.get("parse"):
+            rates["rows_parsed_per_second"] = round(counters["rows_parsed"] / timers["parse"]["seconds"], 1)
+        if counters.get("download_bytes") and timers.get("download"):
+            rates["download_bytes_per_second"] = round(counters["download_bytes"] / timers["download"]["seconds"], 1)
+        if timers.get("insert"):
+            written = counters.get("klines_inserted", 0) + counters.get("klines_skipped", 0) + counters.get("klines_conflicting", 0)
+            rates["klines_written_per_second"] = round(written / timers["insert"]["seconds"], 1)
+        return {"counters": counters, "timers": timers, "rates": rates}
+
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            symbols = sorted({symbol for _, symbol in list(self._counters) + list(self._timers) if symbol is not None})
+            return {
+                "started_at": self.started_at,
+                "elapsed_seconds": round(time.time() - self.started_at, 3),
+                "run": self._summarize(symbol=None),
+                "symbols": {symbol: self._summarize(symbol=symbol) for symbol in symbols},
+            }
+
+
+    def to_prometheus(self) -> str:
+        with self._lock:
+            counters, timers = dict(self._counters), {key: list(value) for key, value in self._timers.items()}
+
+        lines = []
+        for name, description in COUNTERS.items():
+            lines += [f"# HELP {METRICS_PREFIX}_{name}_total {description}", f"# TYPE {METRICS_PREFIX}_{name}_total counter"]
+            for symbol, value in self._get_series(values=counters, name=name):
+                lines.append(f"{METRICS_PREFIX}_{name}_total{self._labels(symbol)} {value:g}")
+        for name, description in TIMERS.items():
+            lines += [f"# HELP {METRICS_PREFIX}_{name}_seconds {description}", f"# TYPE {METRICS_PREFIX}_{name}_seconds summary"]
+            for symbol, (count, total, _) in self._get_series(values=timers, name=name):
+                lines += [f"{METRICS_PREFIX}_{name}_seconds_sum{self._labels(symbol)} {total:.6f}", f"{METRICS_PREFIX}_{name}_seconds_count{self._labels(symbol)} {count:g}"]
+        return "\n".join(lines) + "\n"
+
+
+    @staticmethod
+    def _get_series(values: typing.Dict[typing.Tuple[str, str | None], typing.Any], name: str) -> typing.List[typing.Tuple[str | None, typing.Any]]:
+        # one series per symbol. metrics recorded without a symbol (http) are exported as a single series without labels
+        series = sorted((symbol, value) for (key, symbol), value in values.items() if key == name and symbol is not None)
+        if not series and (name, None) in values:
+            series = [(None, values[(name, None)])]
+        return series
+
+
+    @staticmethod
+    def _labels(symbol: str | None) -> str:
+        return f'{{symbol="{symbol}"}}' if symbol is not None else ""
+
+
+    def write(self, path: str):
+        # prometheus text format for *.prom files (e.g. for the node exporter textfile collector), json otherwise
+        content = self.to_prometheus() if path.endswith(".prom") else json.dumps(self.to_dict(), indent=2)
+        with open(f"{path}.tmp", "w") as fp:
+            fp.write(content)
+        os.replace(f"{path}.tmp", path)
+
+
+
+class MetricsExporter:
+    # writes the metrics every `interval` seconds (long runs, --follow) and once more on close
+    def __init__(self, metrics: Metrics, path: str, interval: float = 0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-exporter", daemon=True) if interval > 0 else None
+        if self._thread is not None:
+            self._thread.start()
+
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.metrics.write(self.path)
+            except Exception as e:
+                logging.warning(f"writing the metrics to {self.path} failed: {e}")
+
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.metrics.write(self.path)
+        logging.info(f"metrics written to {self.path}")
+
+
+
+_metrics = SharedInstance(Metrics)
+configure = _metrics.configure
+get_metrics = _metrics.get
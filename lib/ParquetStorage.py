@@ -0,0 +1,236 @@
+import logging, os, threading, typing
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from lib.Storage import KlineStorage
+from lib.DataStructures import OHLCVBatch, InsertReport, KLINE_DTYPE, TIMESTAMP_FIELDS, TRADE_ID_FIELDS, TRADE_TIME_FIELDS, get_fields_dtype
+from lib.utility import *
+from lib.Types import *
+
+
+PARQUET_COMPRESSION = "zstd"
+PARQUET_ROW_GROUP_SIZE = 100_000
+
+
+class ParquetStorage(KlineStorage):
+    # local columnar storage backend. layout per market, symbol and interval:
+    #   {root_dir}/{market}/{symbol}/{interval}/{YYYY-MM}.parquet                          compacted monthly files
+    #   {root_dir}/{market}/{symbol}/{interval}/daily/{YYYY-MM-DD}.{first_open_time}.parquet  append-only daily parts
+    # the daily parts of a month are compacted into the monthly file as soon as klines of a later month are written.
+    # trades are appended as one file per written batch, named by the first trade id:
+    #   {root_dir}/{market}/{symbol}/{trades|aggTrades}/{first_id:020d}.parquet
+    def __init__(self, root_dir: str, read_only: bool = False):
+        logging.info(f"initializing parquet storage in {root_dir}...")
+        if not read_only:
+            ensure_dir(root_dir)
+        self.root_dir = root_dir
+        
+        self._last_close_times: typing.Dict[typing.Tuple[str, str, str], int | None] = {}
+        self._lock = threading.RLock()
+
+
+    def _get_dir(self, market: t_market, symbol: str, interval: t_interval) -> str:
+        return os.path.join(self.root_dir, market, symbol, interval)
+    
+
+    def _list_files(self, market: t_market, symbol: str, interval: t_interval) -> typing.Dict[str, typing.List[str]]:
+        # file paths grouped by month (YYYY-MM). the monthly file, if any, comes first
+        directory = self._get_dir(market=market, symbol=symbol, interval=interval)
+        daily_directory = os.path.join(directory, "daily")
+        files: typing.Dict[str, typing.List[str]] = {}
+
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(".parquet"):
+                    files.setdefault(name[:7], []).insert(0, os.path.join(directory, name))
+        
+        if os.path.isdir(daily_directory):
+            for name in sorted(os.listdir(daily_directory)):
+                if name.endswith(".parquet"):
+                    files.setdefault(name[:7], []).append(os.path.join(daily_directory, name))
+        
+        return dict(sorted(files.items()))
+
+
+    @staticmethod
+    def _write_table(klines: OHLCVBatch, path: str):
+        table = pa.table({name: np.ascontiguousarray(klines.columns[name]) for name in KLINE_DTYPE.names})
+        ensure_dir(os.path.dirname(path))
+        pq.write_table(table, f"{path}.tmp", compression=PARQUET_COMPRESSION, row_group_size=PARQUET_ROW_GROUP_SIZE)
+        os.replace(f"{path}.tmp", path)
+
+
+    @staticmethod
+    def _read_tables(paths: typing.List[str], columns: typing.List[str] | None = None, start: int | None = None, end: int | None = None) -> np.ndarray:
+        # reads, sorts and deduplicates (a crash during the compaction can leave parts behind) the given files
+        columns = columns or list(KLINE_DTYPE.names)
+        filters = [("open_time", ">=", start)] if start is not None else []
+        filters += [("open_time", "<=", end)] if end is not None else []
+
+        tables = [pq.read_table(path, columns=columns, filters=filters or None) for path in paths]
+        dtype = np.dtype([(name, KLINE_DTYPE[name]) for name in columns])
+        if not tables:
+            return np.empty(0, dtype=dtype)
+
+        table = pa.concat_tables(tables)
+        result = np.empty(table.num_rows, dtype=dtype)
+        for name in columns:
+            result[name] = table.column(name).to_numpy()
+        
+        _, unique_indices = np.unique(result["open_time"], return_index=True)
+        return result[unique_indices]
+    
+
+    @staticmethod
+    def _get_months(ts: np.ndarray) -> np.ndarray:
+        return np.datetime_as_string(unix_ts_to_datetime64(ts).astype("datetime64[M]"))
+
+
+    def _get_last_close_time(self, market: t_market, symbol: str, interval: t_interval) -> int | None:
+        key = (market, symbol, interval)
+        with self._lock:
+            if key not in self._last_close_times:
+                files = self._list_files(market=market, symbol=symbol, interval=interval)
+                close_times = self._read_tables(paths=list(files.values())[-1], columns=["open_time", "close_time"])["close_time"] if files else []
+                self._last_close_times[key] = int(close_times.max()) if len(close_times) else None
+            return self._last_close_times[key]
+
+
+    def _get_first_open_time(self, market: t_market, symbol: str, interval: t_interval) -> int | None:
+        with self._lock:
+            files = self._list_files(market=market, symbol=symbol, interval=interval)
+            open_times = self._read_tables(paths=list(files.values())[0], columns=["open_time"])["open_time"] if files else []
+            return int(open_times.min()) if len(open_times) else None
+
+
+    def read_klines(self, market: t_market, symbol: str, interval: t_interval, start: int | None = None, end: int | None = None, fields: typing.List[str] | None = None) -> OHLCVBatch | np.ndarray:
+        # open_time is always read, the deduplication relies on it
+        columns = ["open_time"] + [name for name in fields if name != "open_time"] if fields is not None else None
+        dtype = get_fields_dtype(fields) if fields is not None else KLINE_DTYPE
+
+        with self._lock:
+            last_close_time = self._get_last_close_time(market=market, symbol=symbol, interval=interval)
+            if last_close_time is None or (start is not None and start > last_close_time):
+                return OHLCVBatch.empty() if fields is None else np.empty(0, dtype=dtype)
+            
+            first_month = self._get_months(np.array([start]))[0] if start is not None else None
+            last_month = self._get_months(np.array([end]))[0] if end is not None else None
+
+            paths = []
+            for month, month_paths in self._list_files(market=market, symbol=symbol, interval=interval).items():
+                if (first_month is None or month >= first_month) and (last_month is None or month <= last_month):
+                    paths += month_paths
+            
+            result = self._read_tables(paths=paths, columns=columns, start=start, end=end)
+        
+        if fields is None:
+            return OHLCVBatch(result)
+        
+        selected = np.empty(len(result), dtype=dtype)
+        for name in fields:
+            selected[name] = result[name]
+        return selected
+
+
+    def read_open_times(self, market: t_market, symbol: str, interval: t_interval) -> np.ndarray:
+        with self._lock:
+            paths = sum(self._list_files(market=market, symbol=symbol, interval=interval).values(), [])
+            return self._read_tables(paths=paths, columns=["open_time"])["open_time"]
+
+
+    def normalize_timestamps(self, market: t_market, symbol: str, interval: t_interval) -> int:
+        # rewrites every month containing klines stored in seconds or microseconds into its monthly file in milliseconds.
+        # klines stored in both units are kept once
+        (_, s_bound), (_, ms_bound), _ = TIMESTAMP_UNIT_BOUNDS
+        n_converted = 0
+        with self._lock:
+            directory = self._get_dir(market=market, symbol=symbol, interval=interval)
+            for month, paths in self._list_files(market=market, symbol=symbol, interval=interval).items():
+                open_times = np.concatenate([pq.read_table(path, columns=["open_time"]).column("open_time").to_numpy() for path in paths])
+                n_month = int(((open_times <= s_bound) | (open_times > ms_bound)).sum())
+                if not n_month:
+                    continue
+
+                logging.info(f"converting {n_month} klines of {symbol}_{interval} ({market}) {month} to milliseconds...")
+                klines = OHLCVBatch(np.concatenate([self._read_tables(paths=[path]) for path in paths]))
+                for name in TIMESTAMP_FIELDS:
+                    klines.columns[name] = unix_ts_to_milliseconds(klines.columns[name])
+                _, unique_indices = np.unique(klines.open_time, return_index=True)
+                self._write_table(klines=klines[unique_indices], path=os.path.join(directory, f"{month}.parquet"))
+                for path in paths:
+                    if os.path.dirname(path) != directory:
+                        os.remove(path)
+                n_converted += n_month
+
+            self._last_close_times.pop((market, symbol, interval), None)
+        return n_converted
+
+
+    def _write_klines(self, market: t_market, symbol: str, interval: t_interval, klines: OHLCVBatch) -> InsertReport:
+        klines = klines[np.argsort(klines.open_time, kind="stable")]
+        days = np.datetime_as_string(unix_ts_to_datetime64(klines.open_time).astype("datetime64[D]"))
+        directory = os.path.join(self._get_dir(market=market, symbol=symbol, interval=interval), "daily")
+
+        with self._lock:
+            # one append-only part per day and write
+            _, day_starts = np.unique(days, return_index=True)
+            for start, end in zip(day_starts, list(day_starts[1:]) + [len(klines)]):
+                part = klines[start:end]
+                self._write_table(klines=part, path=os.path.join(directory, f"{days[start]}.{int(part.open_time[0])}.parquet"))
+
+            key = (market, symbol, interval)
+            self._last_close_times[key] = max(int(klines.close_time.max()), self._last_close_times.get(key) or 0)
+
+            # months followed by a later month are complete
+            last_month = self._get_months(np.array([self._last_close_times[key]]))[0]
+            self.compact(market=market, symbol=symbol, interval=interval, before_month=last_month)
+        
+        return InsertReport(inserted=len(klines))
+
+
+    def _list_trade_files(self, market: t_market, symbol: str, trade_type: t_trade_type) -> typing.List[str]:
+        # ascending trade ids
+        directory = self._get_dir(market=market, symbol=symbol, interval=trade_type)
+        if not os.path.isdir(directory):
+            return []
+        return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(".parquet")]
+
+
+    def _get_last_trade(self, market: t_market, symbol: str, trade_type: t_trade_type) -> typing.Tuple[int, int] | None:
+        id_field, time_field = TRADE_ID_FIELDS[trade_type], TRADE_TIME_FIELDS[trade_type]
+        with self._lock:
+            paths = self._list_trade_files(market=market, symbol=symbol, trade_type=trade_type)
+            if not paths:
+                return None
+            
+            table = pq.read_table(paths[-1], columns=[id_field, time_field])
+            i = int(np.argmax(table.column(id_field).to_numpy()))
+            return int(table.column(id_field)[i].as_py()), int(table.column(time_field)[i].as_py())
+
+
+    def _write_trades(self, market: t_market, symbol: str, trade_type: t_trade_type, trades: np.ndarray) -> InsertReport:
+        trades = trades[np.argsort(trades[TRADE_ID_FIELDS[trade_type]], kind="stable")]
+        directory = self._get_dir(market=market, symbol=symbol, interval=trade_type)
+        path = os.path.join(directory, f"{int(trades[TRADE_ID_FIELDS[trade_type]][0]):020d}.parquet")
+
+        with self._lock:
+            ensure_dir(directory)
+            table = pa.table({name: np.ascontiguousarray(trades[name]) for name in trades.dtype.names})
+            pq.write_table(table, f"{path}.tmp", compression=PARQUET_COMPRESSION, row_group_size=PARQUET_ROW_GROUP_SIZE)
+            os.replace(f"{path}.tmp", path)
+        return InsertReport(inserted=len(trades))
+
+
+    def compact(self, market: t_market, symbol: str, interval: t_interval, before_month: str | None = None):
+        # merges the daily parts of every month (before `before_month`) into the monthly file
+        with self._lock:
+            directory = self._get_dir(market=market, symbol=symbol, interval=interval)
+            for month, paths in self._list_files(market=market, symbol=symbol, interval=interval).items():
+                parts = [path for path in paths if os.path.dirname(path) != directory]
+                if not parts or (before_month is not None and month >= before_month):
+                    continue
+                
+                logging.info(f"compacting {len(parts)} daily parquet files of {symbol}_{interval} ({market}) {month}...")
+                self._write_table(klines=OHLCVBatch(self._read_tables(paths=paths)), path=os.path.join(directory, f"{month}.parquet"))
+                for path in parts:
+                    os.remove(path)
@@ -0,0 +1,71 @@
+import threading, time, typing, logging
+from urllib.parse import urlsplit
+
+
+# request weight budget per minute and host. binance enforces the REST limits per ip over a rolling minute,
+# data.binance.vision (archives) has no published limit and uses a conservative request budget
+RATE_LIMITS_PER_MINUTE: typing.Dict[str, int] = {
+    "api.binance.com": 6000,
+    "data-api.binance.vision": 6000,
+    "fapi.binance.com": 2400,
+    "dapi.binance.com": 2400,
+    "data.binance.vision": 3000,
+}
+DEFAULT_RATE_LIMIT_PER_MINUTE = 1200
+
+# share of the budget actually used. leaves headroom for other clients running on the same ip
+RATE_LIMIT_UTILIZATION = 0.8
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.refill_per_second)
+        self._last_refill = now
+
+
+    def sync_used_weight(self, used_weight: float):
+        # the weight used within the current minute as reported by the server. also covers other clients on the same ip
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, max(0.0, self.capacity - used_weight))
+
+
+    def acquire(self, weight: float = 1):
+        # blocks until `weight` tokens are available. waiting threads are served one after another
+        weight = min(weight, self.capacity)
+        with self._lock:
+            self._refill()
+            while self._tokens < weight:
+                time.sleep((weight - self._tokens) / self.refill_per_second)
+                self._refill()
+            self._tokens -= weight
+
+
+
+_rate_limiters: typing.Dict[str, TokenBucket] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(url: str) -> TokenBucket:
+    # one shared bucket per host and process
+    host = urlsplit(url).hostname
+    with _rate_limiters_lock:
+        if host not in _rate_limiters:
+            per_minute = RATE_LIMITS_PER_MINUTE.get(host, DEFAULT_RATE_LIMIT_PER_MINUTE) * RATE_LIMIT_UTILIZATION
+            logging.debug(f"initializing rate limiter for host {host} with {per_minute} weight per minute")
+            _rate_limiters[host] = TokenBucket(capacity=per_minute, refill_per_second=per_minute / 60)
+        return _rate_limiters[host]
+
+
+def acquire(url: str, weight: float = 1):
+    get_rate_limiter(url).acquire(weight=weight)
@@ -0,0 +1,89 @@
+import logging, typing
+import numpy as np
+from lib.Storage import KlineStorage
+from lib.KlineWriter import KlineWriter
+from lib.DataStructures import OHLCVBatch, KLINE_DTYPE
+from lib.utility import *
+from lib.Types import *
+
+
+# source klines read per chunk. chunks span whole days so that no resampled kline is split between two chunks
+RESAMPLE_CHUNK_SIZE = 500_000
+DAY_MS = 86_400_000
+
+SUMMED_COLUMNS = ["volume", "quote_asset_volume", "number_of_trades", "taker_buy_base_asset_volume", "taker_buy_quote_asset_volume"]
+# binance reports the volumes with up to 8 decimals. rounding removes the floating point error of the sums
+VOLUME_DECIMALS = 8
+
+
+def check_resample_interval(interval: t_interval, target_interval: t_interval):
+    if INTERVAL_SECONDS[target_interval] <= INTERVAL_SECONDS[interval] or INTERVAL_SECONDS[target_interval] % INTERVAL_SECONDS[interval] != 0:
+        raise ValueError(f"{target_interval} klines can not be resampled from {interval} klines. the target interval must be a multiple of the stored interval")
+
+
+def resample_klines(klines: OHLCVBatch, interval: t_interval, target_interval: t_interval, end: int | None = None) -> OHLCVBatch:
+    # aggregates `interval` klines sorted by open_time into klines of the coarser `target_interval`. klines closing after `end`
+    # (ms, defaults to the close_time of the last kline) are still open and dropped. windows with a gap in the source klines
+    # are incomplete and dropped as well instead of being written as a short kline
+    if len(klines) == 0:
+        return OHLCVBatch.empty()
+
+    step = interval_to_milliseconds(target_interval)
+    open_times = unix_ts_to_milliseconds(klines.open_time) // step * step
+    starts = np.flatnonzero(np.r_[True, open_times[1:] != open_times[:-1]])
+    ends = np.r_[starts[1:], len(klines)]
+    is_complete = np.diff(np.r_[starts, len(klines)]) == step // interval_to_milliseconds(interval)
+
+    columns = np.zeros(len(starts), dtype=KLINE_DTYPE)
+    columns["open_time"] = open_times[starts]
+    columns["close_time"] = open_times[starts] + step - 1
+    columns["open"] = klines.open[starts]
+    columns["high"] = np.maximum.reduceat(klines.high, starts)
+    columns["low"] = np.minimum.reduceat(klines.low, starts)
+    columns["close"] = klines.close[ends - 1]
+    for name in SUMMED_COLUMNS:
+        summed = np.add.reduceat(klines.columns[name], starts)
+        columns[name] = summed if name == "number_of_trades" else np.round(summed, VOLUME_DECIMALS)
+
+    end = int(unix_ts_to_milliseconds(klines.close_time[-1:])[0]) if end is None else end
+    return OHLCVBatch(columns[(columns["close_time"] <= end) & is_complete])
+
+
+def resample_symbol(symbol: str, market: t_market, interval: t_interval, target_intervals: typing.List[t_interval], dao: KlineStorage, writer: KlineWriter) -> typing.Dict[str, int]:
+    # builds the target intervals from the stored `interval` klines. every target continues from its own newest kline,
+    # the source klines are read once for all targets. returns the number of resampled klines per target interval
+    for target_interval in target_intervals:
+        check_resample_interval(interval=interval, target_interval=target_interval)
+
+    first_open_time = dao._get_first_open_time(market=market, symbol=symbol, interval=interval)
+    last_close_time = dao._get_last_close_time(market=market, symbol=symbol, interval=interval)
+    if first_open_time is None:
+        logging.warning(f"no {interval} klines stored to resample. symbol: {symbol} market: {market}")
+        return {target_interval: 0 for target_interval in target_intervals}
+    last_close_time = int(unix_ts_to_milliseconds(last_close_time))
+
+    cursors = {}
+    for target_interval in target_intervals:
+        close_time = dao._get_last_close_time(market=market, symbol=symbol, interval=target_interval)
+        cursors[target_interval] = int(unix_ts_to_milliseconds(close_time)) + 1 if close_time is not None else int(unix_ts_to_milliseconds(first_open_time))
+
+    start = min(cursors.values()) // DAY_MS * DAY_MS
+    chunk_size = max(1, RESAMPLE_CHUNK_SIZE * interval_to_milliseconds(interval) // DAY_MS) * DAY_MS
+    logging.info(f"resampling {interval} klines from {timestamp_to_datetime(start)} into {', '.join(target_intervals)}. symbol: {symbol} market: {market}")
+
+    n_resampled = {target_interval: 0 for target_interval in target_intervals}
+    while start <= last_close_time:
+        end = min(start + chunk_size - 1, last_close_time)
+        klines = dao.read_klines(market=market, symbol=symbol, interval=interval, start=start, end=end)
+
+        for target_interval in target_intervals:
+            resampled = resample_klines(klines=klines, interval=interval, target_interval=target_interval, end=end)
+            resampled = resampled[resampled.open_time >= cursors[target_interval]]
+            if len(resampled):
+                writer.put(market=market, symbol=symbol, interval=target_interval, klines=resampled)
+                n_resampled[target_interval] += len(resampled)
+
+        start += chunk_size
+
+    logging.info(f"resampled klines of {symbol} ({market}): {n_resampled}")
+    return n_resampled
@@ -1,72 +1,246 @@
-import logging, os
+import logging, os, io, collections, itertools, functools, typing
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, UTC, timedelta
-from lib.DAO import DAO
+from lib.Storage import KlineStorage
 
-from lib.DataStructures import OHLCV
+from lib.KlineWriter import KlineWriter
+from lib.DataStructures import OHLCV, OHLCVBatch, ArchiveFile, ArchiveDownload, HarvestProgress
+from lib.Manifest import HarvestManifest
+from lib.ZipCache import ZipCache
+from lib.ArchiveListing import ArchiveListingCache
+from lib import Metrics
 from lib.utility import *
 from lib.Types import *
 
 
-def build_url(symbol: str, interval: t_interval, market: t_market, cursor: Cursor):
+# assumed throughput of one download stream for the --dry-run estimate
+ESTIMATED_DOWNLOAD_SPEED = 10 * 2**20
+
+
+def build_url(symbol: str, interval: t_interval, market: t_market, cursor: Cursor, period: t_period = "daily"):
     if market == "cm" or market == "um":
         market = f"futures/{market}"
     
+    if period == "monthly":
+        return f"https://data.binance.vision/data/{market}/monthly/klines/{symbol}/{interval}/{symbol}-{interval}-{cursor.year}-{cursor.get_month()}.zip"
     return f"https://data.binance.vision/data/{market}/daily/klines/{symbol}/{interval}/{symbol}-{interval}-{cursor.year}-{cursor.get_month()}-{cursor.get_day()}.zip"
     
 
+def build_kline_dir(base_dir: str, market: t_market, period: t_period, symbol: str, interval: t_interval):
+    return os.path.join(base_dir, market, period, "klines", symbol, interval)
 
 
-def fetch_and_store_klines(symbol: str, interval: t_interval, market: t_market, 
-                           base_dir: str,
-                           dao: DAO,
-                           use_zip_cache: bool):
-    
+def build_download_plan(cursor: Cursor, now: datetime, use_monthly_archives: bool) -> typing.List[ArchiveFile]:
+    # completed months are covered by one monthly archive each, the rest by daily archives (the current day is not published yet)
+    plan = []
+    while (cursor.year, cursor.month, cursor.day) < (now.year, now.month, now.day):
+        if use_monthly_archives and cursor.day == 1 and (cursor.year, cursor.month) < (now.year, now.month):
+            plan.append(ArchiveFile(period="monthly", cursor=cursor))
+            cursor = (cursor.replace(day=28) + timedelta(days=4)).replace(day=1)
+        else:
+            plan.append(ArchiveFile(period="daily", cursor=cursor))
+            cursor += timedelta(days=1)
+    return plan
+
+
+def plan_archives(symbol: str, interval: t_interval, market: t_market, 
+                  cursor: Cursor, 
+                  now: datetime,
+                  use_monthly_archives: bool = True,
+                  listing: ArchiveListingCache | None = None,
+                  manifest: HarvestManifest | None = None) -> typing.Tuple[typing.List[ArchiveFile], typing.List[ArchiveFile]]:
+    # the archives to download and the daily archives known to be unpublished from the listing. 
+    # without a listing (or if listing fails) unpublished archives are detected by their 404 response
+    plan, unlisted = build_download_plan(cursor=cursor, now=now, use_monthly_archives=use_monthly_archives), []
+    if listing is not None:
+        try:
+            plan, unlisted = listing.filter_plan(symbol=symbol, interval=interval, market=market, plan=plan)
+        except Exception as e:
+            logging.warning(f"listing the archives failed: {e}. probing every archive instead. symbol: {symbol} interval: {interval} market: {market}")
+        if unlisted:
+            logging.info(f"{len(unlisted)} daily archives are not published and skipped ({unlisted[0].get_date()} - {unlisted[-1].get_date()}). symbol: {symbol} interval: {interval} market: {market}")
     
-    # 
-    daily_kline_dir = os.path.join(base_dir, market, "daily", "klines", symbol, interval)
-    ensure_dir(daily_kline_dir)
+    if manifest is not None:
+        plan = manifest.filter_plan(market=market, symbol=symbol, interval=interval, plan=plan, now=now)
+    return plan, unlisted
+
+
+def estimate_archives(symbol: str, interval: t_interval, market: t_market,
+                      dao: KlineStorage,
+                      listing: ArchiveListingCache,
+                      use_monthly_archives: bool = True,
+                      manifest: HarvestManifest | None = None) -> typing.Dict[str, typing.Any]:
+    # --dry-run: the planned archives and their size without downloading or writing anything
+    now = datetime.now(tz=UTC)
+    cursor, _ = dao.get_kline_cursor(symbol=symbol, market=market, interval=interval)
+    plan, unlisted = plan_archives(symbol=symbol, interval=interval, market=market, cursor=cursor, now=now, 
+                                   use_monthly_archives=use_monthly_archives, listing=listing, manifest=manifest)
+
+    sizes = [listing.get_size(symbol=symbol, interval=interval, market=market, archive=archive) for archive in plan]
+    return {
+        "cursor": cursor.isoformat(),
+        "archives": len(plan),
+        "monthly_archives": sum(archive.period == "monthly" for archive in plan),
+        "unpublished_archives": len(unlisted),
+        "unlisted_archives": sum(size is None for size in sizes),  # recent archives, published after the listing or not at all
+        "bytes": sum(size for size in sizes if size is not None),
+        "first": plan[0].get_date() if plan else None,
+        "last": plan[-1].get_date() if plan else None,
+        "files": [build_url(symbol=symbol, interval=interval, market=market, cursor=archive.cursor, period=archive.period).split("/")[-1] for archive in plan],
+    }
+
+
+def fetch_archive(symbol: str, interval: t_interval, market: t_market, archive: ArchiveFile, base_dir: str, zip_cache: ZipCache | None) -> typing.List[ArchiveDownload]:
+    # download stage executed by the worker threads. the source is None if the file does not exist (404)
+    # a missing monthly archive falls back to the daily archives of the same month
+    url = build_url(symbol=symbol, interval=interval, market=market, cursor=archive.cursor, period=archive.period)
+    metrics = Metrics.get_metrics()
+
+    try:
+        with metrics.timer("download", symbol=symbol):
+            if zip_cache is not None:
+                kline_dir = build_kline_dir(base_dir=base_dir, market=market, period=archive.period, symbol=symbol, interval=interval)
+                ensure_dir(kline_dir)
+                zip_source, checksum = zip_cache.get_zip(url=url, base_dir=kline_dir, symbol=symbol)
+            else:
+                zip_source, checksum = download_zip(url=url, symbol=symbol)
+    except requests.exceptions.HTTPError as e:
+        if e.response is None or e.response.status_code != 404:
+            raise e
+        
+        metrics.increment("archives_missing", symbol=symbol)
+        results = [ArchiveDownload(archive=archive, url=url, source=None)]
+        if archive.period == "daily":
+            return results
+        
+        logging.warning(f"monthly archive not found. falling back to daily archives. url: {url}")
+        for day in archive.get_days():
+            results += fetch_archive(symbol=symbol, interval=interval, market=market, archive=day, base_dir=base_dir, zip_cache=zip_cache)
+        return results
+
+    metrics.increment("archives_downloaded", symbol=symbol)
+    metrics.increment("download_bytes", os.path.getsize(zip_source) if isinstance(zip_source, str) else get_file_size(zip_source), symbol=symbol)
+    return [ArchiveDownload(archive=archive, url=url, source=zip_source, checksum=checksum)]
+
+
 
+def fetch_and_store_klines(symbol: str, interval: t_interval, market: t_market, 
+                           base_dir: str,
+                           dao: KlineStorage,
+                           writer: KlineWriter,
+                           zip_cache: ZipCache | None,
+                           download_workers: int = 1,
+                           prefetch_depth: int = 1,
+                           use_monthly_archives: bool = True,
+                           progress: HarvestProgress | None = None,
+                           manifest: HarvestManifest | None = None,
+                           listing: ArchiveListingCache | None = None,
+                           archive_cursor: Cursor | None = None) -> typing.List[ArchiveFile]:
+    # returns the daily archives that are not published (yet). `archive_cursor` is the first day whose archive was not
+    # harvested yet, the storage cursor may be past it once the current day was topped up through the rest api (--follow)
     now = datetime.now(tz=UTC)    
     cursor, is_initial_binance_cursor = dao.get_kline_cursor(symbol=symbol, market=market, interval=interval)
+    if archive_cursor is not None and archive_cursor < cursor:
+        cursor, is_initial_binance_cursor = archive_cursor, False
 
-    
-    total_days = (now - cursor).days
-    i = 0
-    while   (cursor.year < now.year) or \
-            (cursor.year == now.year and cursor.month < now.month) or \
-            (cursor.year == now.year and cursor.month == now.month and cursor.day < now.day):
-        
-        logging.info(f"fetching klines... iteration: {i}")
-        logging.info(f"symbol: {symbol} interval: {interval} market: {market} daily_kline_dir: {daily_kline_dir} zip cache: {use_zip_cache}")
-        logging.info(f"now: {now} cursor: {cursor} total days left: {(now-cursor).days}")
+    plan, unlisted = plan_archives(symbol=symbol, interval=interval, market=market, cursor=cursor, now=now, 
+                                   use_monthly_archives=use_monthly_archives, listing=listing, manifest=manifest)
+    total_archives = len(plan)
 
-        # build url  
-        url = build_url(symbol=symbol, interval=interval, market=market, cursor=cursor)
+    progress = progress or HarvestProgress(symbols=[symbol])
+    progress.start(symbol=symbol, total_archives=total_archives)
+
+    logging.info(f"symbol: {symbol} interval: {interval} market: {market} base_dir: {base_dir} zip cache: {zip_cache is not None} monthly archives: {use_monthly_archives}")
+    logging.info(f"now: {now} cursor: {cursor} total days left: {(now-cursor).days} total archives: {total_archives} download workers: {download_workers} prefetch depth: {prefetch_depth}")
+
+    def record(**kwargs):
+        if manifest is not None:
+            manifest.record(market=market, symbol=symbol, interval=interval, **kwargs)
+
+    missing: typing.List[ArchiveFile] = list(unlisted)
+    for archive in unlisted:
+        record(archive=archive, url=build_url(symbol=symbol, interval=interval, market=market, cursor=archive.cursor, period=archive.period), status="missing")
+
+    # the workers prefetch up to `prefetch_depth` archives ahead. results are consumed strictly in cursor order so that
+    # the database never contains a day whose predecessors are missing (resume logic relies on the newest close_time)
+    metrics = Metrics.get_metrics()
+    pool = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix=f"download-{symbol}")
+    try:
+        archives = iter(plan)
+        pending = collections.deque()
+
+        def submit(archive: ArchiveFile):
+            future = pool.submit(fetch_archive, symbol=symbol, interval=interval, market=market, archive=archive, 
+                                 base_dir=base_dir, zip_cache=zip_cache)
+            pending.append((archive, future))
+
+        for archive in itertools.islice(archives, prefetch_depth):
+            submit(archive)
+
+        i = 0
+        while pending:
+            archive, future = pending.popleft()
+            next_archive = next(archives, None)
+            if next_archive is not None:
+                submit(next_archive)
 
-        # try to download
-        try:
-            unzipped_dir = download_zip(url=url, base_dir=daily_kline_dir, use_zip_cache=use_zip_cache)
-            is_initial_binance_cursor = False
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 404:
-                if is_initial_binance_cursor:
-                    logging.warning(f"start lag detected. url not found. url: {url} symbol: {symbol} market: {market} interval: {interval}")
-                else: 
-                    logging.error(f"url not found. url: {url} symbol: {symbol} market: {market} interval: {interval}")
-                continue
-            else: 
-                raise e
-        finally:
-            logging.info(f"incrementing cursor by 1 day...")
-            cursor += timedelta(days=1)
             i += 1
-            logging.info(f"new cursor: {cursor}")
+            logging.info(f"fetching klines... iteration: {i} {archive.period} archive: {archive.get_date()}")
+
+            try:
+                downloads = future.result()
+            except Exception as e:
+                record(archive=archive, url=build_url(symbol=symbol, interval=interval, market=market, cursor=archive.cursor, period=archive.period), status="failed")
+                raise e
+
+            for download in downloads:
+                if download.source is None:
+                    record(archive=download.archive, url=download.url, status="missing")
+                    if download.archive.period == "monthly":
+                        continue
+                    missing.append(download.archive)
+                    if is_initial_binance_cursor:
+                        logging.warning(f"start lag detected. url not found. url: {download.url} symbol: {symbol} market: {market} interval: {interval}")
+                    else: 
+                        logging.error(f"url not found. url: {download.url} symbol: {symbol} market: {market} interval: {interval}")
+                    continue
+
+                is_initial_binance_cursor = False
 
+                # parse chunk by chunk to keep the memory usage independent of the archive size. 
+                # the writer blocks if it is too far behind which in turn stops new downloads from being submitted
+                n_klines = 0
+                try:
+                    chunks = iter_csv_chunks(zip_source=download.source)
+                    while True:
+                        with metrics.timer("unzip_csv", symbol=symbol, hot_path=True):
+                            raw_klines = next(chunks, None)
+                        if raw_klines is None:
+                            break
 
-        # parse the data 
-        raw_klines = csv_to_list(unzipped_dir=unzipped_dir)
-        parsed_klines = OHLCV.init_from_list(raw_data=raw_klines)
+                        with metrics.timer("parse", symbol=symbol, hot_path=True):
+                            parsed_klines = OHLCVBatch.from_raw(raw_data=raw_klines)
+                        metrics.increment("rows_parsed", len(parsed_klines), symbol=symbol)
 
-        dao.insert_klines_error_resistant(market=market, symbol=symbol, interval=interval, klines=parsed_klines)
-        logging.info(f"{len(parsed_klines)} klines written in database..")
-        logging.info(f"progress: {i}/{total_days}")
+                        writer.put(market=market, symbol=symbol, interval=interval, klines=parsed_klines)
+                        n_klines += len(parsed_klines)
+                except Exception as e:
+                    record(archive=download.archive, url=download.url, status="failed", checksum=download.checksum)
+                    raise e
+                finally:
+                    # parsed, the cached zip may be evicted. the manifest / storage cursor skip it on later runs
+                    if isinstance(download.source, str):
+                        zip_cache.release(download.source)
+                    else:
+                        download.source.close()
+                logging.info(f"{n_klines} klines queued for writing..")
+
+                # the archive counts as ingested once all of its klines are written
+                writer.on_written(market=market, symbol=symbol, interval=interval, 
+                                  callback=functools.partial(record, archive=download.archive, url=download.url, status="ingested", rows=n_klines, checksum=download.checksum))
+            
+            progress.advance(symbol=symbol)
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    
+    return missing
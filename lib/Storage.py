@@ -0,0 +1,172 @@
+import abc, logging, typing
+import numpy as np
+from lib.DataStructures import OHLCVBatch, InsertReport, KLINE_DTYPE, TRADE_ID_FIELDS
+from lib.utility import *
+from lib.Types import *
+
+
+# klines per chunk of iter_klines
+READ_CHUNK_SIZE = 1_000_000
+
+
+class KlineStorage(abc.ABC):
+    # storage interface shared by all backends (MongoDB, parquet files). 
+    # backends implement the primitive reads and writes, the cursor and duplicate handling is shared
+
+    @abc.abstractmethod
+    def _get_last_close_time(self, market: t_market, symbol: str, interval: t_interval) -> int | None:
+        ...
+
+    @abc.abstractmethod
+    def _get_first_open_time(self, market: t_market, symbol: str, interval: t_interval) -> int | None:
+        ...
+
+    @abc.abstractmethod
+    def _write_klines(self, market: t_market, symbol: str, interval: t_interval, klines: OHLCVBatch) -> InsertReport:
+        # writes klines that are not stored yet
+        ...
+
+    @abc.abstractmethod
+    def read_klines(self, market: t_market, symbol: str, interval: t_interval, start: int | None = None, end: int | None = None, fields: typing.List[str] | None = None) -> OHLCVBatch | np.ndarray:
+        # klines with start <= open_time <= end in ascending order. with `fields` only these columns are read and returned 
+        # as a structured array (e.g. fields=["open_time", "close"])
+        ...
+
+    @abc.abstractmethod
+    def normalize_timestamps(self, market: t_market, symbol: str, interval: t_interval) -> int:
+        # one-off migration of klines stored with other timestamp units than milliseconds. returns the number of converted klines
+        ...
+
+    @abc.abstractmethod
+    def read_open_times(self, market: t_market, symbol: str, interval: t_interval) -> np.ndarray:
+        # all stored open_times in ascending order
+        ...
+
+
+    @abc.abstractmethod
+    def _get_last_trade(self, market: t_market, symbol: str, trade_type: t_trade_type) -> typing.Tuple[int, int] | None:
+        # id and time (ms) of the stored trade with the highest id
+        ...
+
+    @abc.abstractmethod
+    def _write_trades(self, market: t_market, symbol: str, trade_type: t_trade_type, trades: np.ndarray) -> InsertReport:
+        # writes trades (structured array of TRADE_DTYPES[trade_type]) that are not stored yet
+        ...
+
+
+    def iter_klines(self, market: t_market, symbol: str, interval: t_interval, start: int | None = None, end: int | None = None, 
+                    fields: typing.List[str] | None = None, chunk_size: int = READ_CHUNK_SIZE) -> typing.Iterator[OHLCVBatch | np.ndarray]:
+        # read_klines for ranges larger than the memory. yields chunks of at most `chunk_size` klines in ascending order
+        first_open_time = self._get_first_open_time(market=market, symbol=symbol, interval=interval)
+        last_close_time = self._get_last_close_time(market=market, symbol=symbol, interval=interval)
+        if first_open_time is None:
+            return
+        
+        start = first_open_time if start is None else max(start, first_open_time)
+        end = last_close_time if end is None else min(end, last_close_time)
+        chunk_span = chunk_size * interval_to_milliseconds(interval)
+
+        while start <= end:
+            chunk = self.read_klines(market=market, symbol=symbol, interval=interval, start=start, end=min(start + chunk_span - 1, end), fields=fields)
+            if len(chunk):
+                yield chunk
+            start += chunk_span
+
+
+    def get_kline_cursor(self, symbol: str, market: t_market, interval: t_interval) -> typing.Tuple[Cursor, bool]:  
+        logging.info("try to fetch kline cursor from storage... ")
+        close_time, cursor, is_initial_binance_cursor = self._get_last_close_time(market=market, symbol=symbol, interval=interval), None, False
+
+        if close_time is not None:
+            next_open_unix = close_time + 1  # adding 1 sec / ms / us / ns .. this should make no difference
+            cursor = timestamp_to_cursor(next_open_unix)
+        else:
+            logging.info("no cursor found in storage. try to initialize from Binance first tick of symbol...")
+            cursor, is_initial_binance_cursor = Binance.get_start_cursor(symbol=symbol, market=market), True
+            logging.info(f"first tick on Binance found. cursor: {cursor}")
+
+        assert isinstance(cursor, Cursor)
+        return cursor, is_initial_binance_cursor
+
+
+    def insert_klines_error_resistant(self, market: t_market, symbol: str, interval: t_interval, klines: OHLCVBatch) -> InsertReport:
+        report = InsertReport()
+        if len(klines) == 0:
+            return report
+
+        # a batch may hold the same kline twice (merged writer batches of an archive and a top-up). time series collections
+        # have no unique index on open_time, the first kline of every open_time is kept
+        _, first = np.unique(klines.open_time, return_index=True)
+        if len(first) != len(klines):
+            report.skipped = len(klines) - len(first)
+            klines = klines[first]
+
+        # single range read over the open_time range covered by the batch
+        existing = self.read_klines(market=market, symbol=symbol, interval=interval, start=int(klines.open_time.min()), end=int(klines.open_time.max()))
+        if len(existing) > 0:
+            is_duplicate = np.isin(klines.open_time, existing.open_time)
+            duplicates = klines[is_duplicate]
+
+            # compare the duplicates with the stored klines of the same open_time
+            stored = existing[np.searchsorted(existing.open_time, duplicates.open_time)]
+            is_equal = np.ones(len(duplicates), dtype=bool)
+            for name in KLINE_DTYPE.names:
+                if name != "ignore":
+                    is_equal &= duplicates.columns[name] == stored.columns[name]
+            
+            report.skipped += int(is_equal.sum())
+            report.conflicting = len(duplicates) - report.skipped
+            if report.conflicting:
+                logging.warning(f"{report.conflicting} klines differ from the already stored klines and are not overwritten. open_times: {duplicates.open_time[~is_equal][:10].tolist()}")
+
+            klines = klines[~is_duplicate]
+
+        if len(klines) > 0:
+            report += self._write_klines(market=market, symbol=symbol, interval=interval, klines=klines)
+
+        logging.debug(f"insert report {symbol}_{interval} ({market}): {report}")
+        return report
+
+
+    def get_trade_cursor(self, symbol: str, market: t_market, trade_type: t_trade_type) -> typing.Tuple[Cursor, int | None, bool]:
+        # the day of the newest stored trade and its id. the archive of that day is read again, trades up to the id are skipped
+        last_trade = self._get_last_trade(market=market, symbol=symbol, trade_type=trade_type)
+        if last_trade is not None:
+            last_id, last_time = last_trade
+            return timestamp_to_cursor(last_time).replace(hour=0, minute=0, second=0, microsecond=0), last_id, False
+        
+        logging.info(f"no {trade_type} found in storage. try to initialize from Binance first tick of symbol...")
+        return Binance.get_start_cursor(symbol=symbol, market=market), None, True
+
+
+    def insert_trades(self, market: t_market, symbol: str, trade_type: t_trade_type, trades: np.ndarray, after_id: int | None = None) -> InsertReport:
+        # trade ids increase monotonically. trades up to `after_id` (the newest stored id) are already stored and skipped
+        report = InsertReport()
+        if after_id is not None:
+            is_stored = trades[TRADE_ID_FIELDS[trade_type]] <= after_id
+            report.skipped = int(is_stored.sum())
+            trades = trades[~is_stored]
+
+        if len(trades) > 0:
+            report += self._write_trades(market=market, symbol=symbol, trade_type=trade_type, trades=trades)
+        return report
+
+
+
+def create_storage(env_config, write_concern: str = "1", time_series: bool = False, read_only: bool = False) -> KlineStorage:
+    # `read_only` storages only read, they never create directories, collections or indexes
+    if env_config.STORAGE_BACKEND == "parquet":
+        from lib.ParquetStorage import ParquetStorage
+        return ParquetStorage(root_dir=env_config.PARQUET_DIR or os.path.join(env_config.BASE_DIR, "parquet"), read_only=read_only)
+    
+    elif env_config.STORAGE_BACKEND == "mongo":
+        from lib.DAO import DAO
+        return DAO(uri = env_config.MONGO_URI, 
+                   SPOT_KLINE_DB = env_config.binance_spot_klines_db, 
+                   UM_KLINE_DB = env_config.binance_um_klines_db, 
+                   CM_KLINE_DB = env_config.binance_cm_klines_db,
+                   write_concern = write_concern,
+                   time_series = time_series,
+                   read_only = read_only)
+    
+    else: raise generate_invalid_arg_exception("STORAGE_BACKEND", env_config.STORAGE_BACKEND)
@@ -0,0 +1,104 @@
+import logging, threading, time, typing
+from pydantic import BaseModel
+from lib.Types import *
+from lib import HttpClient
+from lib.utility import SharedInstance, TTLJsonCache
+
+
+EXCHANGE_INFO_URL: typing.Dict[str, str] = {
+    "spot": "https://api.binance.com/api/v3/exchangeInfo",
+    "um": "https://fapi.binance.com/fapi/v1/exchangeInfo",
+    "cm": "https://dapi.binance.com/dapi/v1/exchangeInfo",
+}
+# request weights of the exchangeInfo endpoints. see https://developers.binance.com/docs
+EXCHANGE_INFO_WEIGHT: typing.Dict[str, int] = {"spot": 20, "um": 1, "cm": 1}
+
+DEFAULT_TTL = 6 * 3600
+# a stale cached copy is only refreshed with a short timeout and without retries, it is used if the api is slow or unreachable
+STALE_REFRESH_TIMEOUT = 5.0
+
+
+class SymbolInfo(BaseModel):
+    symbol: str
+    status: str | None = None
+    onboard_date: int | None = None  # ms, um / cm only
+
+
+class MarketMetadata(BaseModel):
+    fetched_at: float
+    symbols: typing.Dict[str, SymbolInfo]
+
+
+class SymbolMetadataCache:
+    # exchangeInfo reduced to a symbol index per market. kept in memory and (if `cache_dir` is set) as a small json file
+    # per market, so start-up validates hundreds of symbols with dict lookups instead of downloading exchangeInfo.
+    # entries older than `ttl` seconds are refreshed. `offline` never requests exchangeInfo and only uses the cached files
+    def __init__(self, cache_dir: str | None = None, ttl: float = DEFAULT_TTL, offline: bool = False):
+        self.offline = offline
+        self._cache = TTLJsonCache(MarketMetadata, cache_dir=cache_dir, ttl=ttl, exclude_none=True)
+        # one exchangeInfo request per market at a time
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def _fetch(market: t_market, timeout: float | None = None, max_retries: int | None = None) -> MarketMetadata:
+        if market not in EXCHANGE_INFO_URL:
+            raise ValueError(f"invalid market: {market}")
+
+        logging.info(f"downloading exchange info ({market})...")
+        res = HttpClient.get_http_client().get(EXCHANGE_INFO_URL[market], weight=EXCHANGE_INFO_WEIGHT[market], timeout=timeout, max_retries=max_retries)
+
+        symbols = {}
+        for s in res.json()["symbols"]:
+            # spot / um report `status`, cm reports `contractStatus`
+            symbols[s["symbol"]] = SymbolInfo(symbol=s["symbol"], status=s.get("status") or s.get("contractStatus"), onboard_date=s.get("onboardDate"))
+        return MarketMetadata(fetched_at=time.time(), symbols=symbols)
+
+
+    def _is_fresh(self, metadata: MarketMetadata | None) -> bool:
+        return metadata is not None and (self.offline or self._cache.is_fresh(metadata))
+
+
+    def get_market(self, market: t_market) -> MarketMetadata:
+        key = f"exchange_info_{market}"
+        with self._lock:
+            metadata = self._cache.get(key)
+            if not self._is_fresh(metadata):
+                if self.offline:
+                    raise ValueError(f"no cached exchange info for market {market} in offline mode. run once without `--offline-metadata`")
+
+                try:
+                    if metadata is None:
+                        metadata = self._fetch(market)
+                    else:
+                        metadata = self._fetch(market, timeout=STALE_REFRESH_TIMEOUT, max_retries=0)
+                except Exception as e:
+                    if metadata is None:
+                        raise e
+                    logging.warning(f"refreshing exchange info ({market}) failed: {e}. using the cached copy from {time.ctime(metadata.fetched_at)}")
+                else:
+                    self._cache.put(key, metadata)
+            return metadata
+
+
+    def get_symbols(self, market: t_market) -> typing.List[str]:
+        return list(self.get_market(market).symbols)
+
+
+    def get_symbol(self, symbol: str, market: t_market) -> SymbolInfo | None:
+        return self.get_market(market).symbols.get(symbol)
+
+
+    def is_valid(self, symbol: str, market: t_market) -> bool:
+        return self.get_symbol(symbol, market) is not None
+
+
+    def get_onboard_date(self, symbol: str, market: t_market) -> int | None:
+        info = self.get_symbol(symbol, market)
+        return info.onboard_date if info is not None else None
+
+
+
+_symbol_metadata = SharedInstance(SymbolMetadataCache)
+configure = _symbol_metadata.configure
+get_symbol_metadata = _symbol_metadata.get
@@ -0,0 +1,188 @@
+import logging, os, tempfile, typing, zipfile
+from datetime import datetime, UTC
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import requests
+from lib.Storage import KlineStorage
+from lib.DataStructures import ArchiveFile, HarvestProgress, TRADE_DTYPES, TRADE_ID_FIELDS, TRADE_TIME_FIELDS
+from lib.Manifest import HarvestManifest
+from lib.ZipCache import ZipCache
+from lib.SpotKlines import build_download_plan
+from lib import Metrics
+from lib.utility import *
+from lib.Types import *
+
+
+# bytes of csv decoded per batch (~250k trades). every batch is written before the next one is decoded, the memory usage 
+# (~200 MB) does not depend on the archive size (a day of BTCUSDT trades is several GB of csv)
+TRADE_CSV_BLOCK_SIZE = 16 * 2**20
+
+
+def build_trades_url(symbol: str, trade_type: t_trade_type, market: t_market, cursor: Cursor, period: t_period = "daily") -> str:
+    if market == "cm" or market == "um":
+        market = f"futures/{market}"
+
+    date = f"{cursor.year}-{cursor.get_month()}" if period == "monthly" else f"{cursor.year}-{cursor.get_month()}-{cursor.get_day()}"
+    return f"https://data.binance.vision/data/{market}/{period}/{trade_type}/{symbol}/{symbol}-{trade_type}-{date}.zip"
+
+
+def iter_trade_chunks(zip_source: str | typing.BinaryIO, trade_type: t_trade_type, block_size: int = TRADE_CSV_BLOCK_SIZE) -> typing.Iterator[np.ndarray]:
+    # decodes the csv member of the zip on the fly, `block_size` bytes cut at the last line break at a time, and yields one
+    # structured array of TRADE_DTYPES[trade_type] per block. timestamps are converted to milliseconds
+    dtype = TRADE_DTYPES[trade_type]
+    time_field = TRADE_TIME_FIELDS[trade_type]
+
+    with zipfile.ZipFile(zip_source) as zip:
+        members = zip.namelist()
+        if len(members) != 1 or not members[0].endswith(".csv"):
+            raise Exception(f"Unexpected zip structure: {members}")
+
+        with zip.open(members[0]) as fp:
+            # newer archives start with a header row. futures archives have no is_best_match column
+            first_line = fp.readline()
+            names = list(dtype.names[:first_line.count(b",") + 1])
+            read_options = pa_csv.ReadOptions(column_names=names, use_threads=False)
+            convert_options = pa_csv.ConvertOptions(column_types={name: pa.from_numpy_dtype(dtype[name]) for name in names})
+
+            rest = first_line if first_line[:1].isdigit() else b""
+            while True:
+                data = fp.read(block_size)
+                block = rest + data
+                end = block.rfind(b"\n") + 1 if data else len(block)
+                block, rest = block[:end], block[end:]
+                if block.strip():
+                    table = pa_csv.read_csv(pa.py_buffer(block), read_options=read_options, convert_options=convert_options)
+                    trades = np.zeros(table.num_rows, dtype=dtype)
+                    for name in names:
+                        trades[name] = table.column(name).to_numpy()
+
+                    unit = get_timestamp_unit(int(trades[time_field][0]))
+                    if unit != "ms":
+                        trades[time_field] = convert_to_milliseconds(trades[time_field], unit)
+                    yield trades
+                if not data:
+                    break
+
+
+def fetch_trade_archive(symbol: str, trade_type: t_trade_type, market: t_market, archive: ArchiveFile, base_dir: str, zip_cache: ZipCache | None) -> typing.Tuple[str, str, str | typing.BinaryIO] | None:
+    # url, sha256 and the path (zip cache) or temporary file of the archive. None if the archive does not exist (404).
+    # trade archives are too large to be kept in memory
+    url = build_trades_url(symbol=symbol, trade_type=trade_type, market=market, cursor=archive.cursor, period=archive.period)
+    metrics = Metrics.get_metrics()
+
+    fp = None
+    try:
+        with metrics.timer("download", symbol=symbol):
+            if zip_cache is not None:
+                trade_dir = os.path.join(base_dir, market, archive.period, trade_type, symbol)
+                ensure_dir(trade_dir)
+                source, checksum = zip_cache.get_zip(url=url, base_dir=trade_dir, symbol=symbol)
+            else:
+                logging.info(f"downloading {url} into a temporary file...")
+                fp = source = tempfile.TemporaryFile(dir=base_dir)
+                checksum = download(url=url, fp=fp, symbol=symbol)
+                fp.seek(0)
+    except requests.exceptions.HTTPError as e:
+        if fp is not None:
+            fp.close()
+        if e.response is None or e.response.status_code != 404:
+            raise e
+        metrics.increment("archives_missing", symbol=symbol)
+        return None
+
+    metrics.increment("archives_downloaded", symbol=symbol)
+    metrics.increment("download_bytes", os.path.getsize(source) if isinstance(source, str) else get_file_size(fp), symbol=symbol)
+    return url, checksum, source
+
+
+def fetch_and_store_trades(symbol: str, trade_type: t_trade_type, market: t_market,
+                           base_dir: str,
+                           dao: KlineStorage,
+                           zip_cache: ZipCache | None,
+                           use_monthly_archives: bool = True,
+                           progress: HarvestProgress | None = None,
+                           manifest: HarvestManifest | None = None) -> typing.List[ArchiveFile]:
+    # streams the trades / aggTrades archives block by block into the storage. the archives are processed one after another,
+    # a harvest continues after the newest stored trade id. returns the daily archives that are not published (yet)
+    now = datetime.now(tz=UTC)
+    cursor, last_id, is_initial_binance_cursor = dao.get_trade_cursor(symbol=symbol, market=market, trade_type=trade_type)
+
+    plan = build_download_plan(cursor=cursor, now=now, use_monthly_archives=use_monthly_archives)
+    if manifest is not None:
+        plan = manifest.filter_plan(market=market, symbol=symbol, interval=trade_type, plan=plan, now=now)
+
+    total_archives = len(plan)
+    progress = progress or HarvestProgress(symbols=[symbol])
+    progress.start(symbol=symbol, total_archives=total_archives)
+    logging.info(f"symbol: {symbol} data type: {trade_type} market: {market} cursor: {cursor} last trade id: {last_id} total archives: {len(plan)}")
+
+    def record(**kwargs):
+        if manifest is not None:
+            manifest.record(market=market, symbol=symbol, interval=trade_type, **kwargs)
+
+    missing: typing.List[ArchiveFile] = []
+    metrics = Metrics.get_metrics()
+    id_field = TRADE_ID_FIELDS[trade_type]
+
+    archives = list(reversed(plan))
+    while archives:
+        archive = archives.pop()
+        url = build_trades_url(symbol=symbol, trade_type=trade_type, market=market, cursor=archive.cursor, period=archive.period)
+        try:
+            result = fetch_trade_archive(symbol=symbol, trade_type=trade_type, market=market, archive=archive, base_dir=base_dir, zip_cache=zip_cache)
+        except Exception as e:
+            record(archive=archive, url=url, status="failed")
+            raise e
+
+        if result is None:
+            record(archive=archive, url=url, status="missing")
+            if archive.period == "monthly":
+                logging.warning(f"monthly archive not found. falling back to daily archives. url: {url}")
+                archives += reversed(archive.get_days())
+                total_archives += len(archive.get_days()) - 1
+                progress.start(symbol=symbol, total_archives=total_archives)
+                continue
+
+            missing.append(archive)
+            if is_initial_binance_cursor:
+                logging.warning(f"start lag detected. url not found. url: {url} symbol: {symbol} market: {market}")
+            else:
+                logging.error(f"url not found. url: {url} symbol: {symbol} market: {market}")
+            progress.advance(symbol=symbol)
+            continue
+
+        is_initial_binance_cursor = False
+        url, checksum, source = result
+        n_trades = 0
+        try:
+            chunks = iter_trade_chunks(zip_source=source, trade_type=trade_type)
+            while True:
+                with metrics.timer("unzip_csv", symbol=symbol, hot_path=True):
+                    trades = next(chunks, None)
+                if trades is None:
+                    break
+                metrics.increment("trades_parsed", len(trades), symbol=symbol)
+
+                with metrics.timer("insert", symbol=symbol, hot_path=True):
+                    report = dao.insert_trades(market=market, symbol=symbol, trade_type=trade_type, trades=trades, after_id=last_id)
+                metrics.increment("trades_inserted", report.inserted, symbol=symbol)
+                metrics.increment("trades_skipped", report.skipped, symbol=symbol)
+
+                last_id = max(last_id if last_id is not None else -1, int(trades[id_field].max()))
+                n_trades += report.inserted
+        except Exception as e:
+            record(archive=archive, url=url, status="failed", checksum=checksum)
+            raise e
+        finally:
+            if isinstance(source, str):
+                zip_cache.release(source)
+            else:
+                source.close()
+
+        # written synchronously, the archive is ingested
+        logging.info(f"{n_trades} {trade_type} written. {archive.period} archive: {archive.get_date()} symbol: {symbol}")
+        record(archive=archive, url=url, status="ingested", rows=n_trades, checksum=checksum)
+        progress.advance(symbol=symbol)
+
+    return missing
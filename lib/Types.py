@@ -2,8 +2,22 @@ import typing
 
 t_log_level =  typing.Literal["debug", "info", "warning"]
 
+t_command = typing.Literal["harvest", "gaps", "resample", "normalize"]
+
 t_market = typing.Literal["spot", "um", "cm"]
 
+t_period = typing.Literal["daily", "monthly"]
+
+t_storage_backend = typing.Literal["mongo", "parquet"]
+
+t_timestamp_unit = typing.Literal["s", "ms", "us", "ns"]
+
+t_trade_type = typing.Literal["trades", "aggTrades"]
+
+t_data_type = typing.Literal["klines", "trades", "aggTrades"]
+
+t_manifest_status = typing.Literal["ingested", "missing", "failed"]
+
 t_spot_interval = typing.Literal["1s", "1m", "3m", "5m", "15m", "30m", "1h", "2h", "4h", "6h", "8h", "12h", "1d"]
 t_um_interval = typing.Literal["1m", "3m", "5m", "15m", "30m", "1h", "2h", "4h", "6h", "8h", "12h", "1d"]
 t_cm_interval = typing.Literal["1m", "3m", "5m", "15m", "30m", "1h", "2h", "4h", "6h", "8h", "12h", "1d"]
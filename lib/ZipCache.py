@@ -0,0 +1,228 @@
+import logging, os, shutil, sqlite3, threading, time, typing
+from lib.utility import *
+from lib.Types import *
+
+
+class ZipCache:
+    # downloaded archives kept on disk (--use-zip-cache). every cached zip is verified once against the .CHECKSUM file
+    # published by data.binance.vision. its sha256, size and mtime are remembered in an index (sqlite in BASE_DIR)
+    # so that later runs validate a cached zip with a stat call instead of decompressing it.
+    # the index also tracks the last use of every zip. zips unused for `max_age` seconds and the least recently used zips
+    # beyond `max_size` bytes are deleted, zips handed out by get_zip are kept until they are released.
+    # opening the cache changes no files, the harvest runs `maintain` before it uses the cache
+    def __init__(self, index_path: str, max_size: int | None = None, max_age: float | None = None):
+        logging.info(f"opening zip cache index {index_path}...")
+        self.index_path = index_path
+        self.max_size = max_size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._pinned: typing.Dict[str, int] = {}
+
+        self._connection = sqlite3.connect(index_path, check_same_thread=False, timeout=60)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS zips (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    last_used REAL NOT NULL DEFAULT 0
+                )
+            """)
+            # indexes created by older versions
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(zips)")]
+            if "last_used" not in columns:
+                self._connection.execute("ALTER TABLE zips ADD COLUMN last_used REAL NOT NULL DEFAULT 0")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS zips_last_used ON zips (last_used)")
+
+            # running total of the indexed zips, eviction does not have to sum up the index after every download
+            self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM zips").fetchone()[0]
+
+
+    def maintain(self, base_dir: str):
+        # start of a harvest: imports the zips of older versions once and evicts the expired and over-budget zips
+        with self._lock:
+            is_imported = self._connection.execute("PRAGMA user_version").fetchone()[0] >= 1
+        if not is_imported:
+            self._import_legacy_zips(base_dir=base_dir)
+        self.evict()
+
+
+    @staticmethod
+    def _list_legacy_kline_dirs(base_dir: str) -> typing.Iterator[typing.Tuple[str, str]]:
+        # {base_dir}/{market}/{period}/klines/{symbol}/{interval}, the only layout older versions cached archives in.
+        # yields the directory and the file name prefix ({symbol}-{interval}-) of its archives
+        for market in typing.get_args(t_market):
+            for period in typing.get_args(t_period):
+                klines_dir = os.path.join(base_dir, market, period, "klines")
+                if not os.path.isdir(klines_dir):
+                    continue
+                for symbol in os.listdir(klines_dir):
+                    if not os.path.isdir(os.path.join(klines_dir, symbol)):
+                        continue
+                    for interval in os.listdir(os.path.join(klines_dir, symbol)):
+                        if os.path.isdir(os.path.join(klines_dir, symbol, interval)):
+                            yield os.path.join(klines_dir, symbol, interval), f"{symbol}-{interval}-"
+
+
+    def _import_legacy_zips(self, base_dir: str):
+        # one-off pass over the kline archive directories. older versions neither indexed their zips (they would never be
+        # evicted) nor removed the directories the zips were extracted to ({name}/{name}.csv next to {name}.zip).
+        # unknown zips are indexed with their mtime as last use and an empty sha256, they are verified on their next use
+        logging.info(f"importing zips cached by older versions from {base_dir}...")
+        rows, n_dirs = [], 0
+        for kline_dir, prefix in self._list_legacy_kline_dirs(base_dir):
+            for name in os.listdir(kline_dir):
+                path = os.path.join(kline_dir, name)
+                if not name.startswith(prefix):
+                    continue
+                if name.endswith(".zip") and os.path.isfile(path):
+                    stat = os.stat(path)
+                    rows.append((f"{kline_dir}/{name}", stat.st_size, stat.st_mtime_ns, "", stat.st_mtime))
+                elif os.path.isdir(path) and os.listdir(path) == [f"{name}.csv"]:
+                    shutil.rmtree(path, ignore_errors=True)
+                    n_dirs += 1
+
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR IGNORE INTO zips (path, size, mtime_ns, sha256, last_used) VALUES (?, ?, ?, ?, ?)", rows)
+            self._connection.execute("PRAGMA user_version = 1")
+            self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM zips").fetchone()[0]
+        logging.info(f"{len(rows)} cached zips found and {n_dirs} extracted archive directories removed")
+
+
+    def _get_indexed_sha256(self, path: str, stat: os.stat_result) -> str | None:
+        with self._lock:
+            row = self._connection.execute("SELECT size, mtime_ns, sha256 FROM zips WHERE path = ?", (path,)).fetchone()
+        
+        # imported zips have no sha256 until they are verified
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns or not row[2]:
+            return None
+        return row[2]
+
+
+    def _index(self, path: str, sha256: str):
+        stat = os.stat(path)
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT size FROM zips WHERE path = ?", (path,)).fetchone()
+            self._connection.execute("INSERT OR REPLACE INTO zips (path, size, mtime_ns, sha256, last_used) VALUES (?, ?, ?, ?, ?)", 
+                                     (path, stat.st_size, stat.st_mtime_ns, sha256, time.time()))
+            self._size += stat.st_size - (row[0] if row is not None else 0)
+
+
+    def _touch(self, path: str):
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE zips SET last_used = ? WHERE path = ?", (time.time(), path))
+
+
+    def _pin(self, path: str):
+        with self._lock:
+            self._pinned[path] = self._pinned.get(path, 0) + 1
+
+
+    def release(self, path: str):
+        # the caller is done reading the zip returned by get_zip, it may be evicted from now on
+        with self._lock:
+            count = self._pinned.pop(path, 0) - 1
+            if count > 0:
+                self._pinned[path] = count
+
+
+    def get_size(self) -> int:
+        with self._lock:
+            return self._size
+
+
+    def evict(self) -> int:
+        # deletes the expired and the least recently used zips until the cache fits into max_size. 
+        # works on the index only. the rows are read in the order of their last use until the first zip that is
+        # neither expired nor over the budget, usually a single row
+        if self.max_size is None and self.max_age is None:
+            return 0
+
+        with self._lock:
+            expired_before = time.time() - self.max_age if self.max_age is not None else None
+
+            evicted = []
+            for path, size, last_used in self._connection.execute("SELECT path, size, last_used FROM zips ORDER BY last_used ASC"):
+                is_expired = expired_before is not None and last_used < expired_before
+                is_over_budget = self.max_size is not None and self._size > self.max_size
+                if not is_expired and not is_over_budget:
+                    break
+                if path in self._pinned:
+                    continue
+                evicted.append((path,))
+                self._size -= size
+            
+            with self._connection:
+                self._connection.executemany("DELETE FROM zips WHERE path = ?", evicted)
+            total_size = self._size
+
+        for path, in evicted:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        
+        if evicted:
+            logging.info(f"{len(evicted)} zips evicted from the zip cache. cache size: {total_size / 2**30:.2f} GiB")
+        return len(evicted)
+
+
+    def _validate(self, url: str, path: str, sha256: str, symbol: str | None = None) -> bool:
+        checksum = Binance.get_archive_checksum(url=url, symbol=symbol)
+        if checksum is None:
+            logging.warning(f"no checksum published for {url}. falling back to a full zip test")
+            return is_valid_zip(path=path)
+        
+        if checksum != sha256:
+            logging.error(f"checksum mismatch for {path}. expected: {checksum} actual: {sha256}")
+            return False
+        return True
+    
+
+    def get_zip(self, url: str, base_dir: str, symbol: str | None = None) -> typing.Tuple[str, str]:
+        # returns the path and the sha256 of the cached zip. downloads the zip if it is not cached or invalid.
+        # the zip is pinned until it is released
+        path = f"{base_dir}/{url.split('/')[-1]}"
+        self._pin(path)
+        try:
+            return self._get_zip(url=url, path=path, symbol=symbol)
+        except Exception as e:
+            self.release(path)
+            raise e
+
+
+    def _get_zip(self, url: str, path: str, symbol: str | None = None) -> typing.Tuple[str, str]:
+        if os.path.exists(path):
+            sha256 = self._get_indexed_sha256(path=path, stat=os.stat(path))
+            if sha256 is not None:
+                logging.info(f"using cached zip: {path}")
+                self._touch(path)
+                return path, sha256
+            
+            # cached by an older version or modified since. verify once and index it
+            with open(path, "rb") as fp:
+                sha256 = hashlib.file_digest(fp, "sha256").hexdigest()
+            if self._validate(url=url, path=path, sha256=sha256, symbol=symbol):
+                self._index(path=path, sha256=sha256)
+                logging.info(f"using cached zip: {path}")
+                return path, sha256
+        
+        logging.info(f"downloading {url} to destionation path {path}...")
+        partial_path = f"{path}.part"
+        try:
+            with open(partial_path, "wb") as fp:
+                sha256 = download(url=url, fp=fp, symbol=symbol)
+        except Exception as e:
+            os.remove(partial_path)
+            raise e
+        
+        if not self._validate(url=url, path=partial_path, sha256=sha256, symbol=symbol):
+            os.remove(partial_path)
+            raise RuntimeError(f"downloaded zip does not match the published checksum: {url}")
+        
+        os.replace(partial_path, path)
+        self._index(path=path, sha256=sha256)
+        self.evict()
+        return path, sha256
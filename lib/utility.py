@@ -1,8 +1,20 @@
-import logging, os, requests, csv, zipfile
+import logging, os, io, requests, csv, zipfile, hashlib, tempfile, threading, time
+import numpy as np
 from datetime import datetime, UTC
 from lib.Types import *
 
 
+CSV_CHUNK_SIZE = 50_000
+# downloads without the zip cache are kept in memory up to this size and spill into a temporary file beyond it.
+# daily archives fit, monthly 1s archives (hundreds of MB) do not pile up in memory with a deep prefetch queue
+DOWNLOAD_SPOOL_SIZE = 8 * 2**20
+
+INTERVAL_SECONDS: typing.Dict[str, int] = {
+    "1s": 1, "1m": 60, "3m": 180, "5m": 300, "15m": 900, "30m": 1800,
+    "1h": 3600, "2h": 7200, "4h": 14400, "6h": 21600, "8h": 28800, "12h": 43200, "1d": 86400,
+}
+
+
 class Cursor(datetime):
     def get_month(self):
         month = str(self.month)
@@ -17,19 +29,50 @@ class Cursor(datetime):
         return day
     
 
+# upper bounds of the timestamp units. the unit is guessed from the magnitude, unambiguous for all dates between 2001 and 2286
+TIMESTAMP_UNIT_BOUNDS: typing.List[typing.Tuple[t_timestamp_unit, int]] = [("s", 10**12), ("ms", 10**15), ("us", 10**18)]
+
+# multiplier and divisor converting a timestamp of the unit into milliseconds
+TIMESTAMP_UNIT_TO_MILLISECONDS: typing.Dict[str, typing.Tuple[int, int]] = {"s": (1_000, 1), "ms": (1, 1), "us": (1, 1_000), "ns": (1, 1_000_000)}
+
+
+def get_timestamp_unit(ts: int) -> t_timestamp_unit:
+    for unit, bound in TIMESTAMP_UNIT_BOUNDS:
+        if ts <= bound:
+            return unit
+    return "ns"
+
+
+def convert_to_milliseconds(ts: np.ndarray, unit: t_timestamp_unit) -> np.ndarray:
+    # whole column conversion with integer arithmetic
+    multiplier, divisor = TIMESTAMP_UNIT_TO_MILLISECONDS[unit]
+    return np.asarray(ts, dtype=np.int64) * multiplier // divisor
+
+
 def unix_ts_to_seconds(ts):
-    ts = int(float(ts))
+    # integer arithmetic up to milliseconds, int(float(ts)) loses the precision of ns timestamps
+    try:
+        ts = int(ts)
+    except ValueError:
+        ts = int(float(ts))
+    return int(convert_to_milliseconds(ts, get_timestamp_unit(ts))) / 1e3
+
+
 
-    if ts > 1e18:   # ns
-        return ts / 1e9
-    elif ts > 1e15: # us
-        return ts / 1e6
-    elif ts > 1e12: # ms
-        return ts / 1e3
-    else:           # s
-        return ts
+def unix_ts_to_milliseconds(ts: np.ndarray) -> np.ndarray:
+    # vectorized variant of unix_ts_to_seconds with millisecond precision. the unit is guessed per value (mixed units)
+    ts = np.asarray(ts, dtype=np.int64)
+    (_, s_bound), (_, ms_bound), (_, us_bound) = TIMESTAMP_UNIT_BOUNDS
+    return np.where(ts > us_bound, ts // 1_000_000, np.where(ts > ms_bound, ts // 1_000, np.where(ts > s_bound, ts, ts * 1_000)))
 
 
+def unix_ts_to_datetime64(ts: np.ndarray) -> np.ndarray:
+    return unix_ts_to_milliseconds(ts).astype("datetime64[ms]")
+
+
+def interval_to_milliseconds(interval: t_interval) -> int:
+    return INTERVAL_SECONDS[interval] * 1000
+
 
 def timestamp_to_cursor(ts):
     return Cursor.fromtimestamp(unix_ts_to_seconds(ts), tz=UTC)
@@ -60,89 +103,210 @@ def is_dir_empty(path: str):
     return len(os.listdir(path=path)) == 0
 
 
-def download_zip(url: str, base_dir: str, use_zip_cache: bool):
-        def download(url: str, file_path: str): 
-            logging.info(f"downloading {url} to destionation path {file_path}...")
-            with requests.get(url) as req: 
-                req.raise_for_status()
-                with open(file_path, "wb") as fp:
-                    for chunk in req.iter_content(chunk_size=8192): 
-                        fp.write(chunk)
+_T = typing.TypeVar("_T")
+
+
+class SharedInstance(typing.Generic[_T]):
+    # process-wide instance of `factory`, created with the default settings on first use. configure() replaces it
+    def __init__(self, factory: typing.Callable[..., _T]):
+        self._factory = factory
+        self._instance: _T | None = None
+        self._lock = threading.Lock()
+
+
+    def configure(self, **kwargs) -> _T:
+        with self._lock:
+            self._instance = self._factory(**kwargs)
+            return self._instance
+
+
+    def get(self) -> _T:
+        with self._lock:
+            if self._instance is None:
+                self._instance = self._factory()
+            return self._instance
+
+
+
+class TTLJsonCache(typing.Generic[_T]):
+    # pydantic models with a `fetched_at` timestamp, kept in memory and (if `cache_dir` is set) as one json file per key.
+    # entries older than `ttl` seconds are stale, the caller decides whether to refresh them
+    def __init__(self, model: typing.Type[_T], cache_dir: str | None = None, ttl: float = 0, exclude_none: bool = False):
+        self.model = model
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.exclude_none = exclude_none
+
+        self._entries: typing.Dict[str, _T] = {}
+        self._lock = threading.Lock()
+
+        if cache_dir is not None:
+            ensure_dir(cache_dir)
+
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+
+    def _load(self, key: str) -> _T | None:
+        if self.cache_dir is None or not os.path.isfile(self.get_path(key)):
+            return None
+        try:
+            with open(self.get_path(key), "r") as fp:
+                return self.model.model_validate_json(fp.read())
+        except Exception as e:
+            logging.warning(f"ignoring unreadable cache file {self.get_path(key)}: {e}")
+            return None
+
+
+    def get(self, key: str) -> _T | None:
+        # the entry in memory or, if it is missing or stale, the cached file (another process may have refreshed it).
+        # possibly stale
+        with self._lock:
+            entry = self._entries.get(key)
+            if not self.is_fresh(entry):
+                loaded = self._load(key)
+                if loaded is not None and (entry is None or loaded.fetched_at > entry.fetched_at):
+                    entry = self._entries[key] = loaded
+            return entry
 
-        full_filepath_zip = f"{base_dir}/{url.split('/')[-1]}"
-        full_path_unzipped_dir = full_filepath_zip[:-4]
 
-        if use_zip_cache and os.path.exists(path=full_filepath_zip) and is_valid_zip(path=full_filepath_zip):
-            logging.info(f"using cached zip: {full_filepath_zip}")
-        else:
-            download(url=url, file_path=full_filepath_zip)
+    def put(self, key: str, entry: _T):
+        with self._lock:
+            self._entries[key] = entry
+        if self.cache_dir is None:
+            return
+        path = self.get_path(key)
+        with open(f"{path}.tmp", "w") as fp:
+            fp.write(entry.model_dump_json(exclude_none=self.exclude_none))
+        os.replace(f"{path}.tmp", path)
+
+
+    def is_fresh(self, entry: _T | None) -> bool:
+        return entry is not None and time.time() - entry.fetched_at < self.ttl
+
+
+def download(url: str, fp: typing.BinaryIO, symbol: str | None = None) -> str: 
+    # streams the response body into fp and returns its sha256
+    return HttpClient.get_http_client().download(url=url, fp=fp, symbol=symbol)
+
+
+def get_file_size(fp: typing.BinaryIO) -> int:
+    position = fp.tell()
+    size = fp.seek(0, io.SEEK_END)
+    fp.seek(position)
+    return size
+
+
+def download_zip(url: str, symbol: str | None = None) -> typing.Tuple[tempfile.SpooledTemporaryFile, str]:
+    # the zip is not cached, it is deleted once the returned file is closed. see ZipCache for cached downloads
+    logging.info(f"downloading {url} into a spooled temporary file...")
+    fp = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_SIZE)
+    try:
+        sha256 = download(url=url, fp=fp, symbol=symbol)
+    except Exception as e:
+        fp.close()
+        raise e
+    fp.seek(0)
+    return fp, sha256
+
+
+def iter_csv_chunks(zip_source: str | typing.BinaryIO, chunk_size: int = CSV_CHUNK_SIZE) -> typing.Iterator[typing.List[typing.List[str]]]:
+    # decodes the csv member of the zip on the fly and yields its rows in chunks of at most `chunk_size` rows
+    with zipfile.ZipFile(zip_source) as zip:
+        members = zip.namelist()
+        logging.debug(f"zip content: {members}")
+
+        if len(members) != 1 or not members[0].endswith(".csv"):
+            raise Exception(f"Unexpected zip structure: {members}")
         
-        logging.info(f"extracting zip to destination path {full_path_unzipped_dir}")
-        with zipfile.ZipFile(file=full_filepath_zip) as zip:
-            zip.extractall(path=full_path_unzipped_dir)
+        with zip.open(members[0]) as fp:
+            csv_reader = csv.reader(io.TextIOWrapper(fp, encoding="utf-8", newline=""), delimiter=",")
+
+            chunk = []
+            for row in csv_reader:
+                if not row or not row[0].isdigit():  # skip empty lines and the header row of newer archives
+                    continue
+
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            
+            if chunk:
+                yield chunk
 
-        return full_path_unzipped_dir
 
 
-def csv_to_list(unzipped_dir: str):
-    logging.info("Converting CSV to list...")
-    rows = []
 
-    dir_content = os.listdir(unzipped_dir)
-    logging.debug(f"Directory content: {dir_content}")
+class Binance: 
+    KLINES_URL: typing.Dict[str, str] = {
+        "spot": "https://data-api.binance.vision/api/v3/klines",
+        "um": "https://fapi.binance.com/fapi/v1/klines",
+        "cm": "https://dapi.binance.com/dapi/v1/klines",
+    }
+    KLINES_LIMIT = 1000
 
-    if len(dir_content) != 1 and not dir_content[0].endswith(".csv"):
-        raise Exception(f"Unexpected directory structure: {unzipped_dir}")
 
-    csv_path = f"{unzipped_dir}/{dir_content[0]}"
-    with open(csv_path, mode="r") as fp:
-        csv_reader = csv.reader(fp, delimiter=",")
-        rows = [row for row in csv_reader]
+    @staticmethod
+    def get_klines_weight(market: t_market, limit: int) -> int:
+        if market == "spot":
+            return 2
+        return 1 if limit < 100 else 2 if limit < 500 else 5 if limit <= 1000 else 10
     
-    return rows
 
+    @staticmethod
+    def get(url: str, weight: int, symbol: str | None = None) -> requests.Response:
+        return HttpClient.get_http_client().get(url, weight=weight, symbol=symbol)
 
 
+    @staticmethod
+    def get_archive_checksum(url: str, symbol: str | None = None) -> str | None:
+        # sha256 published next to every archive on data.binance.vision ("<sha256>  <file name>")
+        try:
+            res = Binance.get(f"{url}.CHECKSUM", weight=1, symbol=symbol)
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise e
+        return res.text.split()[0].lower()
+
 
-class Binance: 
     @staticmethod
     def get_all_symbols(market: t_market) -> typing.List[str]:
-        if market == "um":
-            res = requests.get("https://fapi.binance.com/fapi/v1/exchangeInfo")
-        elif market == "cm":
-            res = requests.get("https://dapi.binance.com/dapi/v1/exchangeInfo")
-        elif market == "spot":
-            res = requests.get("https://api.binance.com/api/v3/exchangeInfo")
-        else: raise generate_invalid_arg_exception("market", market)
-
-        res.raise_for_status()
-        return [symbol['symbol'] for symbol in res.json()['symbols']]
+        if market not in SymbolMetadata.EXCHANGE_INFO_URL:
+            raise generate_invalid_arg_exception("market", market)
+        return SymbolMetadata.get_symbol_metadata().get_symbols(market=market)
     
 
     @staticmethod
     def get_start_cursor(symbol: str, market: t_market) -> Cursor: 
         if market == "um":
-            res = requests.get(f"https://fapi.binance.com/fapi/v1/klines?symbol={symbol}&interval=1m&limit=1&startTime=0")
-            res.raise_for_status()
-            return timestamp_to_cursor(res.json()[0][0])
+            return timestamp_to_cursor(Binance.get_klines(symbol=symbol, market=market, interval="1m", start_time=0, limit=1)[0][0])
 
         elif market == "cm":
-            exchange_info = requests.get("https://dapi.binance.com/dapi/v1/exchangeInfo")
-            exchange_info.raise_for_status()
-
-            onboard_date = None
-            for s in exchange_info.json()["symbols"]: 
-                if s["symbol"] == symbol: 
-                    onboard_date = s["onboardDate"]
-                    break
-            
+            onboard_date = SymbolMetadata.get_symbol_metadata().get_onboard_date(symbol=symbol, market=market)
             if onboard_date == None:
                 raise ValueError(f"symbol {symbol} (cm) not found in exchange info endpoint")
             return timestamp_to_cursor(onboard_date)
             
         elif market == "spot":
-            res = requests.get(f"https://data-api.binance.vision/api/v3/klines?symbol={symbol}&interval=1m&limit=1&startTime=0")
-            res.raise_for_status()
-            return timestamp_to_cursor(res.json()[0][0])
+            return timestamp_to_cursor(Binance.get_klines(symbol=symbol, market=market, interval="1m", start_time=0, limit=1)[0][0])
         
         else: raise generate_invalid_arg_exception("market", market)
+
+
+    @staticmethod
+    def get_klines(symbol: str, market: t_market, interval: t_interval, start_time: int, end_time: int | None = None, limit: int = KLINES_LIMIT) -> typing.List[typing.List]:
+        if market not in Binance.KLINES_URL:
+            raise generate_invalid_arg_exception("market", market)
+        
+        url = f"{Binance.KLINES_URL[market]}?symbol={symbol}&interval={interval}&limit={limit}&startTime={start_time}"
+        if end_time is not None:
+            url += f"&endTime={end_time}"
+        return Binance.get(url, weight=Binance.get_klines_weight(market=market, limit=limit), symbol=symbol).json()
+
+
+
+# imported last: both modules build on the helpers above
+from lib import HttpClient, SymbolMetadata
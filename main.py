@@ -1,14 +1,63 @@
-import coloredlogs
+import coloredlogs, logging, os
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional
-from lib.DAO import DAO
+from lib.Storage import create_storage
+from lib import Metrics
 from lib.ArgparserValidation import parse_args
 from pprint import pprint
-from lib.SpotKlines import fetch_and_store_klines
+from lib.SpotKlines import fetch_and_store_klines, estimate_archives, ESTIMATED_DOWNLOAD_SPEED
+from lib.Trades import fetch_and_store_trades
+from lib.KlineWriter import KlineWriter
+from lib.Gaps import find_and_fill_gaps
+from lib.Resample import resample_symbol
+from lib.Follow import FollowScheduler, top_up_klines
+from lib.DataStructures import HarvestProgress
+from lib.Manifest import HarvestManifest
+from lib.ZipCache import ZipCache
+from lib.ArchiveListing import ArchiveListingCache
+from lib.utility import Cursor
 
 
 
 
 
+def dry_run(args):
+    # --dry-run: prints the planned archives and their size. reads the storage and the manifest without creating or
+    # migrating anything, the listings are kept in memory only
+    env_config = args.env_config
+    dao = create_storage(env_config = env_config, read_only = True)
+    manifest_path = os.path.join(env_config.BASE_DIR, "manifest.sqlite3")
+    manifest = HarvestManifest(path = manifest_path, read_only = True) if args.use_manifest and os.path.isfile(manifest_path) else None
+    listing = ArchiveListingCache()
+
+    def estimate(symbol: str):
+        try:
+            return symbol, estimate_archives(symbol = symbol, 
+                                             interval = args.interval, 
+                                             market = args.market, 
+                                             dao = dao, 
+                                             listing = listing, 
+                                             use_monthly_archives = args.use_monthly_archives, 
+                                             manifest = manifest)
+        except Exception as e:
+            logging.exception(f"planning {symbol} failed: {e}")
+            return symbol, {"error": str(e)}
+
+    with ThreadPoolExecutor(max_workers = args.symbol_workers, thread_name_prefix = "symbol") as pool:
+        plans = dict(pool.map(estimate, args.symbols))
+    
+    total_bytes = sum(plan.get("bytes", 0) for plan in plans.values())
+    streams = min(args.symbol_workers, len(args.symbols)) * args.download_workers
+    pprint("dry run. planned archives per symbol:")
+    pprint(plans)
+    pprint({
+        "archives": sum(plan.get("archives", 0) for plan in plans.values()),
+        "bytes": total_bytes,
+        "gib": round(total_bytes / 2**30, 3),
+        "estimated_download_seconds": round(total_bytes / (ESTIMATED_DOWNLOAD_SPEED * streams)),
+    })
+
+
 def main(argv: Optional[List[str]] = None):
     # parse args
     args = parse_args(argv)
@@ -17,23 +66,135 @@ def main(argv: Optional[List[str]] = None):
     coloredlogs.install(level=args.log_level)
 
     pprint("running with following configuration:")
-    pprint(args.model_dump(exclude=["env_config.MONGO_URI"]))
+    pprint(args.model_dump(exclude={"env_config": {"MONGO_URI"}}))
 
 
-    dao = DAO(uri = env_config.MONGO_URI, 
-              SPOT_KLINE_DB = env_config.binance_spot_klines_db, 
-              UM_KLINE_DB = env_config.binance_um_klines_db, 
-              CM_KLINE_DB = env_config.binance_cm_klines_db)
+    metrics = Metrics.configure(profile = args.profile is not None)
 
-    
+    if args.dry_run and args.command == "harvest":
+        # before any storage, cache, manifest or writer is created. a dry run changes nothing
+        return dry_run(args)
+
+    exporter = Metrics.MetricsExporter(metrics = metrics, path = args.metrics_file, interval = args.metrics_interval) if args.metrics_file else None
+
+    dao = create_storage(env_config = env_config, 
+                         write_concern = args.write_concern,
+                         time_series = args.time_series)
+
+    writer = KlineWriter(dao = dao, 
+                         batch_size = args.write_batch_size, 
+                         queue_size = args.write_queue_size)
+
+    progress = HarvestProgress(symbols = args.symbols)
+    zip_cache = ZipCache(index_path = os.path.join(env_config.BASE_DIR, "zip_cache.sqlite3"), 
+                         max_size = args.zip_cache_size, 
+                         max_age = args.zip_cache_max_age * 86400 if args.zip_cache_max_age else None) if args.use_zip_cache else None
+    manifest = HarvestManifest(path = os.path.join(env_config.BASE_DIR, "manifest.sqlite3")) if args.use_manifest else None
+    listing = ArchiveListingCache(cache_dir = os.path.join(env_config.BASE_DIR, "listings")) if args.use_listing else None
+
+    def harvest_archives(symbol: str, progress: HarvestProgress | None = None, archive_cursor: Cursor | None = None):
+        if args.data_type != "klines":
+            return fetch_and_store_trades(symbol = symbol, 
+                                          trade_type = args.data_type, 
+                                          market = args.market, 
+                                          base_dir = env_config.BASE_DIR, 
+                                          dao = dao, 
+                                          zip_cache = zip_cache, 
+                                          use_monthly_archives = args.use_monthly_archives, 
+                                          progress = progress, 
+                                          manifest = manifest)
+        return fetch_and_store_klines(symbol = symbol, 
+                                      interval = args.interval, 
+                                      market = args.market,
+                                      base_dir = env_config.BASE_DIR, 
+                                      dao = dao,
+                                      writer = writer,
+                                      zip_cache = zip_cache,
+                                      use_monthly_archives = args.use_monthly_archives,
+                                      download_workers = args.download_workers,
+                                      prefetch_depth = args.prefetch_depth,
+                                      progress = progress,
+                                      manifest = manifest,
+                                      listing = listing,
+                                      archive_cursor = archive_cursor)
+
+    def follow_archives(symbol: str, archive_cursor: Cursor | None):
+        # after a restart the storage may already hold the top-ups of days whose archives were not harvested yet
+        if archive_cursor is None and manifest is not None and args.data_type == "klines":
+            archive_cursor = manifest.get_archive_cursor(market = args.market, symbol = symbol, interval = args.interval)
+        return harvest_archives(symbol = symbol, archive_cursor = archive_cursor)
+
+    def top_up(symbol: str, cursor: int | None):
+        return top_up_klines(symbol = symbol, 
+                             market = args.market, 
+                             interval = args.interval, 
+                             dao = dao, 
+                             writer = writer, 
+                             cursor = cursor)
+
+    def harvest(symbol: str):
+        try:
+            if args.command == "gaps":
+                find_and_fill_gaps(symbol = symbol, 
+                                   market = args.market, 
+                                   interval = args.interval, 
+                                   dao = dao, 
+                                   writer = writer, 
+                                   fill = args.fill_gaps)
+            elif args.command == "resample":
+                resample_symbol(symbol = symbol, 
+                                market = args.market, 
+                                interval = args.interval, 
+                                target_intervals = args.resample_intervals, 
+                                dao = dao, 
+                                writer = writer)
+            elif args.command == "normalize":
+                dao.normalize_timestamps(market = args.market, 
+                                         symbol = symbol, 
+                                         interval = args.interval)
+            else:
+                harvest_archives(symbol = symbol, progress = progress)
+        except Exception as e:
+            # one failing symbol must not abort the others
+            logging.exception(f"harvesting {symbol} failed: {e}")
+            progress.finish(symbol = symbol, error = e)
+        else:
+            progress.finish(symbol = symbol)
+
+    if zip_cache is not None and args.command == "harvest":
+        zip_cache.maintain(base_dir = env_config.BASE_DIR)
+
+    try:
+        if args.follow and args.command == "harvest":
+            # dao, http pool, metadata cache, manifest and zip cache stay warm between the runs
+            FollowScheduler(symbols = args.symbols, 
+                            interval = args.interval, 
+                            harvest = follow_archives, 
+                            top_up = top_up if args.top_up else None, 
+                            workers = args.symbol_workers, 
+                            spread = args.follow_spread).run()
+            return
+        
+        with ThreadPoolExecutor(max_workers = args.symbol_workers, thread_name_prefix = "symbol") as pool:
+            list(pool.map(harvest, args.symbols))
+    finally:
+        # every teardown step runs, also if an earlier one failed. the first error is raised
+        try:
+            # checkpoint: write everything that is still buffered, also if the run was interrupted
+            writer.close()
+        finally:
+            try:
+                if exporter is not None:
+                    exporter.close()
+            finally:
+                if args.profile is not None:
+                    metrics.dump_profile(args.profile)
+
+    logging.info(f"metrics: {metrics.to_dict()['run']}")
 
-    for symbol in args.symbols:
-        fetch_and_store_klines(symbol = symbol, 
-                               interval = args.interval, 
-                               market = args.market,
-                               base_dir = env_config.BASE_DIR, 
-                               dao = dao,
-                               use_zip_cache = args.use_zip_cache)
+    logging.info(f"finished symbols: {len(progress.finished)}/{len(args.symbols)}")
+    for symbol, error in progress.failed.items():
+        logging.error(f"failed symbol: {symbol} error: {error}")
 
     return
     
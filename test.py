@@ -2,7 +2,7 @@ import pymongo, typing, requests
 from datetime import datetime
 from lib.utility import unix_ts_to_seconds
 from lib.Types import t_interval
-from lib.DataStructures import OHLCV
+from lib.DataStructures import OHLCVBatch
 
 
 def main(interval_seconds: int) -> typing.List[typing.List[int]]:
@@ -49,14 +49,14 @@ def main(interval_seconds: int) -> typing.List[typing.List[int]]:
 
 
 
-def api(symbol: str, interval: t_interval, limit: int, startTime: int) -> typing.List[OHLCV]:
+def api(symbol: str, interval: t_interval, limit: int, startTime: int) -> OHLCVBatch:
     url = f"https://data-api.binance.vision/api/v3/klines?symbol={symbol}&interval={interval}&limit={limit}&startTime={startTime}"
 
     res = requests.get(url)
     res.raise_for_status()
 
     res_json = res.json()
-    return OHLCV.init_from_list(raw_data=res_json)
+    return OHLCVBatch.from_raw(raw_data=res_json)
 
 
 if __name__ == "__main__":
@@ -72,11 +72,11 @@ if __name__ == "__main__":
             add_data = api(symbol="BTCUSDT", interval="1m", limit=len(batch_timestamps), startTime=int(batch_timestamps[0]*1000 - 1))
 
 
-            print("gap-start:", batch_timestamps[0],  "api-data-start: ", add_data[0].open_time)
-            print("gap-end:  ", batch_timestamps[-1], "api-data-end:   ", add_data[-1].open_time)
+            print("gap-start:", batch_timestamps[0],  "api-data-start: ", add_data.open_time[0])
+            print("gap-end:  ", batch_timestamps[-1], "api-data-end:   ", add_data.open_time[-1])
 
-            print("gap-start (inclusive):", datetime.fromtimestamp(batch_timestamps[0]),  "api-data-start: ", datetime.fromtimestamp(unix_ts_to_seconds(add_data[0].open_time)))
-            print("gap-end (inclusive):  ", datetime.fromtimestamp(batch_timestamps[-1]), "api-data-end:   ", datetime.fromtimestamp(unix_ts_to_seconds(add_data[-1].open_time)))
+            print("gap-start (inclusive):", datetime.fromtimestamp(batch_timestamps[0]),  "api-data-start: ", datetime.fromtimestamp(unix_ts_to_seconds(add_data.open_time[0])))
+            print("gap-end (inclusive):  ", datetime.fromtimestamp(batch_timestamps[-1]), "api-data-end:   ", datetime.fromtimestamp(unix_ts_to_seconds(add_data.open_time[-1])))
 
             print(len(batch_timestamps), len(add_data))
             break
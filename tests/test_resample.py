@@ -0,0 +1,29 @@
+from lib.DataStructures import OHLCVBatch
+from lib.Resample import resample_klines
+
+
+START = 1_700_006_400_000  # 2023-11-15 00:00 UTC, start of an hour
+
+
+def make_klines(minutes):
+    return OHLCVBatch.from_raw(raw_data=[[START + i * 60_000, "1", "2", "0.5", "1.5", "1", START + i * 60_000 + 59_999, "1.5", 1, "0.5", "0.75", "0"] for i in minutes])
+
+
+def test_resample_complete_window():
+    resampled = resample_klines(klines=make_klines(range(60)), interval="1m", target_interval="1h")
+
+    assert len(resampled) == 1
+    assert resampled.open_time[0] == START
+    assert resampled.close_time[0] == START + 3_600_000 - 1
+    assert resampled.volume[0] == 60
+    assert resampled.number_of_trades[0] == 60
+
+
+def test_resample_drops_window_with_gap():
+    # minute 30 of the first hour is missing, the second hour is complete
+    minutes = [i for i in range(120) if i != 30]
+    resampled = resample_klines(klines=make_klines(minutes), interval="1m", target_interval="1h")
+
+    assert len(resampled) == 1
+    assert resampled.open_time[0] == START + 3_600_000
+    assert resampled.volume[0] == 60
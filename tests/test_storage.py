@@ -0,0 +1,29 @@
+from benchmark import MemoryStorage
+from lib.DataStructures import OHLCVBatch
+
+
+START = 1_700_006_400_000
+
+
+def make_klines(minutes):
+    return OHLCVBatch.from_raw(raw_data=[[START + i * 60_000, "1", "2", "0.5", "1.5", "1", START + i * 60_000 + 59_999, "1.5", 1, "0.5", "0.75", "0"] for i in minutes])
+
+
+def test_insert_skips_duplicates_within_batch():
+    # MemoryStorage has no unique index on open_time, like a time series collection
+    dao = MemoryStorage()
+    report = dao.insert_klines_error_resistant(market="spot", symbol="BTCUSDT", interval="1m", klines=make_klines([0, 1, 1, 2]))
+
+    assert report.inserted == 3
+    assert report.skipped == 1
+    assert dao.read_open_times(market="spot", symbol="BTCUSDT", interval="1m").tolist() == [START, START + 60_000, START + 120_000]
+
+
+def test_insert_skips_stored_and_duplicated_klines():
+    dao = MemoryStorage()
+    dao.insert_klines_error_resistant(market="spot", symbol="BTCUSDT", interval="1m", klines=make_klines([0, 1]))
+    report = dao.insert_klines_error_resistant(market="spot", symbol="BTCUSDT", interval="1m", klines=make_klines([1, 1, 2, 2]))
+
+    assert report.inserted == 1
+    assert report.skipped == 3
+    assert len(dao.read_open_times(market="spot", symbol="BTCUSDT", interval="1m")) == 3